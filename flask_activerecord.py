@@ -7,13 +7,140 @@
     :license: BSD, see LICENSE for more details.
 """
 
-__all__ = ['patch_model', 'json_value']
-
+__all__ = ['patch_model', 'json_value', 'statement_cache_info', 'query_cache_info',
+           'request_cache_info', 'MemoryCache', 'SQLiteCache']
+
+import time
+import pickle
+import sqlite3
+import weakref
+import threading
 import datetime as dt
-from functools import wraps
+from array import array
+from collections import OrderedDict
+from contextlib import contextmanager
+from itertools import islice
+from operator import attrgetter
+import flask
 import flask_sqlalchemy
-from sqlalchemy.orm import RelationshipProperty, \
-    object_mapper, class_mapper, defer, eagerload
+from sqlalchemy import and_, or_, bindparam, event, orm
+from sqlalchemy.orm import Mapper, RelationshipProperty, \
+    object_mapper, class_mapper, defer, load_only
+
+try:
+    from sqlalchemy.ext import baked
+except ImportError:  # SQLAlchemy < 1.0
+    baked = None
+
+try:
+    string_types = basestring
+except NameError:  # Python 3
+    string_types = str
+
+
+class _LRUCache(object):
+    """A thread-safe mapping bounded to `maxsize` entries which evicts the least
+    recently used entries first and counts lookup hits and misses
+    """
+
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._data)
+
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                value = self._data.pop(key)
+            except KeyError:
+                self.misses += 1
+                return default
+            self._data[key] = value
+            self.hits += 1
+            return value
+
+    def pop(self, key, default=None):
+        with self._lock:
+            return self._data.pop(key, default)
+
+    def set(self, key, value):
+        with self._lock:
+            self._data.pop(key, None)
+            self._data[key] = value
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self.hits = self.misses = 0
+
+    def info(self):
+        return dict(hits=self.hits, misses=self.misses, size=len(self._data), maxsize=self.maxsize)
+
+
+try:
+    array('q')
+    _INT_TYPECODE = 'q'
+except ValueError:  # Python 2
+    _INT_TYPECODE = 'l'
+
+#: `array` type codes for storing column values by their python type
+_ARRAY_TYPECODES = {bool: 'b', int: _INT_TYPECODE, float: 'd'}
+
+#: SQL functions supported by :meth:`_QueryHelper.aggregate`
+_AGGREGATES = frozenset(['count', 'sum', 'avg', 'min', 'max'])
+
+#: loader strategy used to eager load collections
+_COLLECTION_LOADER = 'selectinload' if hasattr(orm, 'selectinload') else 'subqueryload'
+
+#: the number of query shapes to keep compiled statements for
+STATEMENT_CACHE_SIZE = 500
+
+#: the number of `to_dict` field specs to keep serialization plans for
+SERIALIZATION_CACHE_SIZE = 500
+
+#: the number of results to keep for queries cached with :meth:`_QueryHelper.cache`
+QUERY_CACHE_SIZE = 500
+
+#: results with more rows than this are not kept in the query cache
+QUERY_CACHE_MAX_ROWS = 1000
+
+#: the default number of seconds to keep results in the query cache
+QUERY_CACHE_TTL = 300
+
+_statements = _LRUCache(STATEMENT_CACHE_SIZE)
+_serialization_plans = _LRUCache(SERIALIZATION_CACHE_SIZE)
+_query_results = _LRUCache(QUERY_CACHE_SIZE)
+_bakery = baked.bakery(size=STATEMENT_CACHE_SIZE) if baked else None
+
+#: write counters of tables, bumped on every write through the models mapped to them
+_table_versions = {}
+
+
+def statement_cache_info():
+    """Returns the hits, misses and size of the compiled statement cache
+    shared by queries of all models
+    """
+    return _statements.info()
+
+
+def query_cache_info():
+    """Returns the hits, misses and size of the cache of query results"""
+    return _query_results.info()
+
+
+def request_cache_info():
+    """Returns the number of read queries deduplicated (hits) and issued (misses) in
+    the current request, with `ACTIVERECORD_DEDUPLICATE_QUERIES` enabled, else `None`
+    """
+    memo = _request_memo()
+    return memo.info() if memo is not None else None
 
 
 def patch_model():
@@ -30,55 +157,349 @@ def _get_mapper(obj):
     return mapper(obj)
 
 
-__CACHE = {}
-
+class _ModelInfo(object):
+    """Metadata of a mapped model resolved once per class. Names are held in tuples,
+    preserving the mapper order, and in frozensets for membership tests
+    """
 
-def _memoize(f):
-    @wraps(f)
-    def wrapper(obj):
-        key = f.__name__
-        mapper = _get_mapper(obj)
-        if mapper in __CACHE and key in __CACHE[mapper]:
-            return __CACHE[mapper][key]
-        __CACHE.setdefault(mapper, {})
-        __CACHE[mapper][key] = f(obj)
-        return __CACHE[mapper][key]
-    return wrapper
+    def __init__(self, model, mapper):
+        self.attribute_filters = model.__attribute_filters__
+        self.columns = tuple(mapper.c.keys())
+        self.primary_keys = tuple(key for key, val in mapper.c.items() if val.primary_key)
+        self.relationships = dict((p.key, p) for p in mapper.iterate_properties
+                                  if isinstance(p, RelationshipProperty))
+        self.relations = tuple(key for key in mapper.attrs.keys() if key in self.relationships)
+        self.column_set = frozenset(self.columns)
+        self.primary_key_set = frozenset(self.primary_keys)
+        self.relation_set = frozenset(self.relations)
+
+        self.hidden = frozenset(self.attribute_filters.get('hidden', EMPTY))
+        self.protected = frozenset(self.attribute_filters.get('protected', EMPTY))
+        self.accessible = frozenset(self.attribute_filters.get('accessible', EMPTY))
+        self.assignable = frozenset(key for key in self.columns if key not in self.protected and
+                                    (not self.accessible or key in self.accessible))
+        self.record_class = None
+        self.cache = None
+        self.scopes = {}
+        self.counter_caches = ()
+
+
+_registry = weakref.WeakKeyDictionary()
+_registry_lock = threading.Lock()
+
+
+def _register_model(model, mapper=None):
+    info = _ModelInfo(model, mapper or class_mapper(model))
+    config = getattr(model, '__cache__', None)
+    if config:
+        previous = _registry.get(model)
+        if previous is not None and previous.cache is not None and previous.cache.config is config:
+            info.cache = previous.cache
+        else:
+            info.cache = _ModelCache(model, config)
+    with _registry_lock:
+        _registry[model] = info
+    # scopes are built once the model is registered, as building queries looks it up
+    for name, scope in getattr(model, '__scopes__', {}).items():
+        info.scopes[name] = _compile_scope(model, scope)
+    info.counter_caches = tuple(_CounterCache(model, relation, column)
+                                for relation, column in getattr(model, '__counter_caches__', {}).items())
+    return info
+
+
+def _compile_scope(model, scope):
+    """Returns the query of the given scope with its conditions resolved and compiled"""
+    query = scope(_QueryHelper(model))
+    if not isinstance(query, _QueryHelper):
+        raise ValueError("Expected scope of '%s' to return a query" % model.__name__)
+    return query._resolve()
+
+
+def _scope_accessor(name):
+    def scope(cls):
+        return _model_info(cls).scopes[name]
+
+    scope.__name__ = name
+    scope.__doc__ = "Returns the query of the `%s` scope" % name
+    scope.is_scope = True
+    return classmethod(scope)
+
+
+@event.listens_for(Mapper, 'instrument_class')
+def _on_instrument_class(mapper, model):
+    if issubclass(model, ActiveRecord):
+        for name in getattr(model, '__scopes__', {}):
+            existing = getattr(model, name, None)
+            if existing is not None and not getattr(existing, 'is_scope', False):
+                raise ValueError("Scope '%s' conflicts with attribute of '%s'" % (name, model.__name__))
+            setattr(model, name, _scope_accessor(name))
+
+
+@event.listens_for(Mapper, 'mapper_configured')
+def _on_mapper_configured(mapper, model):
+    if issubclass(model, ActiveRecord):
+        _register_model(model, mapper)
+        for name in ('after_insert', 'after_update', 'after_delete'):
+            event.listen(mapper, name, _on_record_written)
+        if model.__counter_caches__:
+            event.listen(mapper, 'after_insert', _on_counted_insert)
+            event.listen(mapper, 'after_update', _on_counted_update)
+            event.listen(mapper, 'before_delete', _on_counted_delete)
+
+
+def _model_info(obj):
+    """Returns the registered metadata for the given model or instance of a model"""
+    model = obj if isinstance(obj, type) else type(obj)
+    info = _registry.get(model)
+    # attribute filters may be reassigned on the class after it was mapped
+    if info is None or info.attribute_filters is not model.__attribute_filters__:
+        info = _register_model(model)
+    return info
 
 
-@_memoize
 def _get_primary_keys(obj):
-    """Returns the name of the primary key of the specified model or instance
-    of a model, as a string.
-
-    If `model_or_instance` specifies multiple primary keys and `'id'` is one
-    of them, `'id'` is returned. If `model_or_instance` specifies multiple
-    primary keys and `'id'` is not one of them, only the name of the first
-    one in the list of primary keys is returned.
+    """Returns a `tuple` of the primary key names of the given model or instance
     """
-    return [key for key, val in _get_mapper(obj).c.items() if val.primary_key]
+    return _model_info(obj).primary_keys
 
 
-@_memoize
 def _get_columns(model):
-    """Returns a `list` of columns names of the given model
+    """Returns a `tuple` of columns names of the given model
     """
-    return [key for key, val in _get_mapper(model).c.items()]
+    return _model_info(model).columns
 
 
-@_memoize
 def _get_relations(model):
-    """Return a `list` of relationship names or the given model
+    """Return a `tuple` of relationship names or the given model
+    """
+    return _model_info(model).relations
+
+
+def _assignable(model, values):
+    """Returns the subset of `values` which may be mass-assigned to the columns of
+    the given model or instance, filtering out *protected* attributes and allowing
+    only *accessible* attributes if non-empty
+    """
+    assignable = _model_info(model).assignable
+    return dict((key, value) for key, value in values.items() if key in assignable)
+
+
+#: maximum number of bind parameters per statement for databases limiting them
+_MAX_BIND_PARAMS = {'sqlite': 999, 'mssql': 2000, 'oracle': 1000}
+
+
+def _get_bind(model):
+    """Returns the engine the given model is bound to in the current session"""
+    return model.query.session.get_bind(_get_mapper(model))
+
+
+def _chunk_size(model, default=1000):
+    """Returns how many primary key values of the model fit in a single statement"""
+    limit = min(_MAX_BIND_PARAMS.get(_get_bind(model).dialect.name, default), default)
+    return max(1, limit // len(_get_primary_keys(model)))
+
+
+def _primary_key_clause(model, ids):
+    """Builds a condition matching the records with the given primary key values.
+    Values for composite primary keys are given as tuples
+    """
+    keys = _get_primary_keys(model)
+    if len(keys) == 1:
+        return getattr(model, keys[0]).in_(ids)
+    columns = [getattr(model, k) for k in keys]
+    return or_(*[and_(*[c == v for c, v in zip(columns, pk)]) for pk in ids])
+
+
+def _identity_lookup(model, pk):
+    """Returns the instance of the model with the given primary key value
+    if present in the identity map of the current session
+    """
+    key = _get_mapper(model).identity_key_from_primary_key(
+        list(pk) if isinstance(pk, tuple) else [pk])
+    return model.query.session.identity_map.get(key)
+
+
+def _expunge_identities(model, ids):
+    """Removes instances of the model with the given primary key values from the
+    current session, used after deleting them with a bulk statement
     """
-    return [c.key for c in _get_mapper(model).iterate_properties if isinstance(c, RelationshipProperty)]
+    session = model.query.session
+    for pk in ids:
+        obj = _identity_lookup(model, pk)
+        if obj is not None:
+            session.expunge(obj)
+
+
+def _chunked(iterable, size):
+    """Yields successive lists of at most `size` items from the iterable"""
+    it = iter(iterable)
+    while True:
+        chunk = list(islice(it, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+class _Batch(object):
+    """The unit of work of an :meth:`ActiveRecord.batch` block"""
+
+    def __init__(self, flush_every):
+        self.flush_every = flush_every
+        self.pending = 0
+
+
+def _commit(session):
+    """Commits the session, unless in an :meth:`ActiveRecord.batch` block where it is
+    flushed once every `flush_every` writes and committed at the end of the block
+    """
+    batch = session.info.get('activerecord.batch')
+    if batch is None:
+        session.commit()
+        return
+    batch.pending += 1
+    if batch.pending >= batch.flush_every:
+        session.flush()
+        batch.pending = 0
+
+
+def _isoformat(value):
+    return value.isoformat()
+
+
+def _column_converter(column):
+    """Returns a function converting values of the column to JSON values,
+    or `None` if the values need no conversion
+    """
+    try:
+        python_type = column.type.python_type
+    except NotImplementedError:
+        return json_value
+    if python_type in (int, float, bool, str):
+        return None
+    if python_type in (dt.datetime, dt.date, dt.time):
+        return _isoformat
+    return json_value
+
+
+class _SerializationPlan(object):
+    """A `to_dict` field spec compiled for a model. Holds a flat list of attribute
+    getters and value converters for the columns to serialize, and nested plans for
+    the relationship fields.
+    """
+
+    def __init__(self, model, fields, exclude):
+        info = _model_info(model)
+        columns = _get_mapper(model).c
+
+        fields = list(fields)
+        if fields and len(fields) == 1:
+            fields = [s.strip() for s in fields[0].split(',')]
+        if isinstance(exclude, str):
+            exclude = [e.strip() for e in exclude.split(',')]
+
+        # select columns given or all if non was specified
+        model_attr = set(info.column_set)
+        if info.column_set.isdisjoint(fields):
+            fields = model_attr | set(fields)
+
+        # correctly filter relation attributes and column attributes
+        related_attr = set(fields) - model_attr
+        model_attr = set(fields) - (set(exclude) | related_attr)
+
+        # check if remaining fields are valid related attributes
+        related_map = {}
+        for k in related_attr:
+            k, _, attr = k.partition('.')
+            if k in info.relation_set:
+                related_map.setdefault(k, [])
+                if attr:
+                    related_map[k].append(attr)
+
+        self.columns = []
+        self.relations = []
+        # the metadata the plan was built with, including that of nested plans
+        self.infos = [(model, info)]
+
+        # no fields to return
+        if not model_attr and not related_map:
+            return
+
+        model_attr |= info.primary_key_set
+        model_attr -= info.hidden
+
+        for k in info.columns:
+            if k in model_attr:
+                self.columns.append((k, attrgetter(k), _column_converter(columns[k])))
+
+        for k in info.relations:
+            if k in related_map:
+                target = info.relationships[k].mapper.class_
+                plan = _serialization_plan(target, tuple(related_map[k]), EMPTY)
+                self.relations.append((k, attrgetter(k), related_map[k], target, plan))
+                self.infos.extend(plan.infos)
+
+    def is_current(self):
+        """Returns true unless attribute filters of the models were reassigned since"""
+        for model, info in self.infos:
+            if _model_info(model) is not info:
+                return False
+        return True
+
+    def __bool__(self):
+        return bool(self.columns or self.relations)
+
+    __nonzero__ = __bool__
+
+    def serialize(self, models, props):
+        """Returns a `list` of `dict` for the given models applying this plan"""
+        result = []
+
+        for model in models:
+            data = {}
+
+            # handle column attributes
+            for k, getter, convert in self.columns:
+                v = getter(model)
+                data[k] = v if convert is None or v is None else convert(v)
+
+            # handle relationships
+            for k, getter, fields, target, plan in self.relations:
+                val = getter(model)
+                if not val:
+                    data[k] = [] if isinstance(val, list) else {}
+                    continue
+                first = val[0] if isinstance(val, list) else val
+                if type(first) is not target:
+                    plan = _serialization_plan(type(first), tuple(fields), EMPTY)
+                if isinstance(val, list):
+                    data[k] = plan.serialize(val, {}) if plan else {}
+                else:
+                    data[k] = plan.serialize([val], {})[0] if plan else {}
+
+            # handle extra properties
+            for k in props:
+                data[k] = props[k]
+                if callable(data[k]):
+                    data[k] = data[k](model)
+
+            result.append(data)
+
+        return result
+
+
+def _serialization_plan(model, fields, exclude):
+    """Returns the cached serialization plan of the model for the given field spec"""
+    key = (model, fields, exclude if isinstance(exclude, str) else tuple(exclude))
+    plan = _serialization_plans.get(key)
+    if plan is None or not plan.is_current():
+        plan = _SerializationPlan(model, fields, exclude)
+        _serialization_plans.set(key, plan)
+    return plan
 
 
 def _model_to_dict(models, *fields, **props):
     """Serialize an ActiveRecord object to a JSON dict
     """
-    result = []
-    fields = list(fields)
-
     has_many = isinstance(models, list)
 
     # terminate early if there is nothing to work on
@@ -88,74 +509,83 @@ def _model_to_dict(models, *fields, **props):
     if not has_many:
         models = [models]
 
-    if fields and len(fields) == 1:
-        fields = [s.strip() for s in fields[0].split(',')]
-
     # pop of meta information
     # _overwrite = props.pop('_overwrite', None)
-    _exclude = props.pop('_exclude', [])
-    if isinstance(_exclude, str):
-        _exclude = [e.strip() for e in _exclude.split(',')]
-
-    # select columns given or all if non was specified
-    model_attr = set(_get_columns(models[0]))
-    if not model_attr & set(fields):
-        fields = model_attr | set(fields)
-
-    # correctly filter relation attributes and column attributes
-    related_attr = set(fields) - model_attr
-    model_attr = set(fields) - (set(_exclude) | related_attr)
-
-    # check if there are relationships
-    related_fields = _get_relations(models[0])
-    related_map = {}
-    # check if remaining fields are valid related attributes
-    for k in related_attr:
-        if '.' in k:
-            index = k.index('.')
-            model, attr = k[:index], k[index + 1:]
-            if model in related_fields:
-                related_map[model] = related_map.get(model, [])
-            related_map[model].append(attr)
-        elif k in related_fields:
-            related_map[k] = []
+    _exclude = props.pop('_exclude', EMPTY)
+
+    plan = _serialization_plan(type(models[0]), fields, _exclude)
 
     # no fields to return
-    if not model_attr and not related_map:
+    if not plan:
         return {}
 
-    for key in _get_primary_keys(models[0]):
-        model_attr.add(key)
+    result = plan.serialize(models, props)
+    return result if has_many else result[0]
 
-    for model in models:
-        data = {}
 
-        hidden_attributes = model.__attribute_filters__.get('hidden', EMPTY)
+class _Record(object):
+    """Base class of the read-only records generated for each model by
+    :meth:`_QueryHelper.records`, holding column values in slots
+    """
+    __slots__ = ()
 
-        # handle column attributes
-        for k in model_attr:
-            if k in hidden_attributes:
-                continue
-            v = getattr(model, k)
-            # change dates to human readable format
-            data[k] = json_value(v)
+    #: the model the record was generated for
+    _model = None
 
-        # handle relationships
-        for k in related_map:
-            val = getattr(model, k)
-            fields = related_map[k]
-            data[k] = _model_to_dict(val, *fields)
+    def __init__(self, *values):
+        for key, value in zip(self.__slots__, values):
+            object.__setattr__(self, key, value)
 
-        # handle extra properties
-        for k in props:
-            data[k] = props[k]
-            if callable(data[k]):
-                data[k] = data[k](model)
+    def __setattr__(self, key, value):
+        raise AttributeError("'%s' object is read-only" % self.__class__.__name__)
 
-        result.append(data)
+    def __delattr__(self, key):
+        raise AttributeError("'%s' object is read-only" % self.__class__.__name__)
+
+    def __reduce__(self):
+        return _make_record, (self._model, self._values())
+
+    def __eq__(self, other):
+        return type(other) is type(self) and other._values() == self._values()
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return hash(self._values())
+
+    def __repr__(self):
+        return "%s(\n%s\n)" % (
+            self.__class__.__name__,
+            ', \n'.join(["  %s=%r" % (c, getattr(self, c)) for c in self.__slots__]))
+
+    def _values(self):
+        return tuple(getattr(self, k) for k in self.__slots__)
+
+    def to_dict(self, *fields, **kwargs):
+        """Serialize the record to a `dict` as with :meth:`ActiveRecord.to_dict`.
+        Only column attributes are available on records.
+        """
+        plan = _serialization_plan(self._model, fields, kwargs.pop('_exclude', EMPTY))
+        if plan.relations:
+            raise ValueError("Relationships of '%s' are not loaded in records" % self._model.__name__)
+        return plan.serialize([self], kwargs)[0] if plan else {}
+
+
+def _record_class(model):
+    """Returns the record class generated for the given model"""
+    info = _model_info(model)
+    if info.record_class is None:
+        info.record_class = type('%sRecord' % model.__name__, (_Record,), {
+            '__slots__': info.columns,
+            '__module__': model.__module__,
+            '_model': model
+        })
+    return info.record_class
 
-    result = result if has_many else result[0]
-    return result
+
+def _make_record(model, values):
+    return _record_class(model)(*values)
 
 
 def json_value(value):
@@ -177,32 +607,121 @@ def json_value(value):
         return str(value)
 
 
+def _keyset_clause(model, keys, values):
+    """Builds a seek condition matching the rows ordered after `values` on the
+    given primary `keys`. Composite keys are expanded to the portable form of
+    `(k1, k2) > (v1, v2)`, i.e. `k1 > v1 OR (k1 = v1 AND k2 > v2)`
+    """
+    clauses = []
+    for i, key in enumerate(keys):
+        terms = [getattr(model, k) == v for k, v in zip(keys[:i], values[:i])]
+        terms.append(getattr(model, key) > values[i])
+        clauses.append(and_(*terms))
+    return or_(*clauses)
+
+
+def _relation_loader(model, key, path=None):
+    """Returns the eager loading option for a relationship of the model, chained from
+    the loader `path` if given. Collections are loaded with a separate `IN` query
+    and many-to-one relations with a join.
+    """
+    relation = _model_info(model).relationships[key]
+    strategy = _COLLECTION_LOADER if relation.uselist else 'joinedload'
+    return getattr(path if path is not None else orm, strategy)(getattr(model, key))
+
+
+def _plan_options(model, plan, path=None):
+    """Returns loader options fetching only the attributes serialized by the plan,
+    eager loading its relationships with their nested attributes
+    """
+    columns = [k for k, _, _ in plan.columns]
+    options = []
+    if columns:
+        options.append(path.load_only(*columns) if path is not None else load_only(*columns))
+    elif path is not None:
+        options.append(path)
+
+    for k, _, _, target, nested in plan.relations:
+        loader = _relation_loader(model, k, path)
+        options.extend(_plan_options(target, nested, loader) if nested else [loader])
+
+    return options
+
+
 def _select_options(model, *fields):
     """Projects given columns to be included in query output
     """
-    pk_columns = set(_get_primary_keys(model))
-    all_columns = set(_get_columns(model))
-    relations = set(_get_relations(model))
+    info = _model_info(model)
+    all_columns = info.column_set
+    relations = info.relation_set
 
-    fields = set(fields) | pk_columns if fields else all_columns
+    fields = info.primary_key_set.union(fields) if fields else all_columns
     options = []
 
-    # include PKs and defer unrequested attributes (including related)
-    # NB: intentionally allows fields like "related.attribute" to pass through
+    # include PKs and defer unrequested attributes, eager loading relations
+    # including those of fields like "related.attribute"
 
     for key in (all_columns - fields):
         options.append(defer(getattr(model, key)))
-    for key in (relations & fields):
-        options.append(eagerload(getattr(model, key)))
+    for key in relations.intersection(f.partition('.')[0] for f in fields):
+        options.append(_relation_loader(model, key))
 
     return options
 
 
+def _bind_name(key, index):
+    """Returns the name of the bind parameter for a value of a filter.
+    The name never clashes with those SQLAlchemy generates for anonymous parameters
+    """
+    return '%s__w%d' % (key, index)
+
+
+def _where_shape(model, **filters):
+    """Returns the shape of the column filters and the values of their bind parameters.
+
+    The shape is a tuple of `(key, operator, arity)` for each column filter. `IN` lists
+    are padded to a power of two so that queries of a similar size share a shape.
+    """
+    shape = []
+    params = {}
+
+    for key in sorted(_model_info(model).column_set.intersection(filters)):
+        value = filters[key]
+
+        if isinstance(value, tuple):
+            # ensure only two values in tuple
+            if len(value) != 2:
+                raise ValueError(
+                    "Expected tuple of size 2 generate BETWEEN expression "
+                    "for column '%s.%s'" % (model.__name__, key))
+            op, value = 'between', [min(value), max(value)]
+        elif value is None:
+            op, value = 'is_null', []
+        elif not isinstance(value, list):
+            op, value = '=', [value]
+        elif not value:
+            raise ValueError(
+                "Expected non-empty list to generate IN expression "
+                "for column '%s.%s'" % (model.__name__, key))
+        elif len(value) == 1:
+            op, value = ('is_null', []) if value[0] is None else ('=', value)
+        else:
+            op = 'in'
+            value = value + value[-1:] * ((1 << (len(value) - 1).bit_length()) - len(value))
+
+        shape.append((key, op, len(value)))
+        for i, v in enumerate(value):
+            params[_bind_name(key, i)] = v
+
+    return tuple(shape), params
+
+
 def _where_clause(model, *criteria, **filters):
     """Builds a list of where conditions for this applying the correct operators
     for representing the values.
 
     `=` expression is generated for single simple values (int, str, datetime, etc.)
+    `IS NULL` expression is generated for `None`
     `IN` expression is generated for list/set of simple values
     `BETWEEN` expression is generated for 2-tuple of simple values
     """
@@ -211,7 +730,7 @@ def _where_clause(model, *criteria, **filters):
     if not filters:
         return conditions
 
-    for key in set(_get_relations(model)) & set(filters.keys()):
+    for key in _model_info(model).relation_set.intersection(filters):
         value = filters[key]
         if not isinstance(value, list):
             value = [value]
@@ -222,27 +741,30 @@ def _where_clause(model, *criteria, **filters):
             # Not implemented yet as of SQLAlchemy 0.7.9
             conditions.append(getattr(model, key).in_(value))
 
-    for key in set(_get_columns(model)) & set(filters.keys()):
-        value = filters[key]
+    shape, params = _where_shape(model, **filters)
+    conditions.extend(_column_conditions(model, shape, params))
+    return conditions
 
-        if isinstance(value, tuple):
-            # ensure only two values in tuple
-            if len(value) != 2:
-                raise ValueError(
-                    "Expected tuple of size 2 generate BETWEEN expression "
-                    "for column '%s.%s'" % (model.__name__, key))
-            lower, upper = min(value), max(value)
-            value = (lower, upper)
-        elif not isinstance(value, list):
-            value = [value]
-        elif not value:
-            raise ValueError(
-                "Expected non-empty list to generate IN expression "
-                "for column '%s.%s'" % (model.__name__, key))
 
-        if len(value) == 1:
+def _column_conditions(model, shape, params, unique=False):
+    """Builds the conditions of column filters of the given shape binding the parameters.
+
+    :param unique: flag to give the bind parameters unique names, so that they do not
+        clash with those of other filters of the same columns in a statement
+    """
+    conditions = []
+    columns = _get_mapper(model).c
+
+    for key, op, arity in shape:
+        value = [bindparam(_bind_name(key, i), params[_bind_name(key, i)],
+                           type_=columns[key].type, unique=unique)
+                 for i in range(arity)]
+
+        if op == '=':
             value = getattr(model, key) == value[0]
-        elif isinstance(value, tuple):
+        elif op == 'is_null':
+            value = getattr(model, key).is_(None)
+        elif op == 'between':
             value = getattr(model, key).between(value[0], value[1])
         else:
             value = getattr(model, key).in_(value)
@@ -252,83 +774,962 @@ def _where_clause(model, *criteria, **filters):
     return conditions
 
 
+class MemoryCache(object):
+    """An in-process cache backend for records of models declaring `__cache__`,
+    evicting the least recently used entries beyond `max_entries`
+    """
+
+    def __init__(self, max_entries=10000):
+        self._entries = _LRUCache(max_entries)
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        expires, value = entry
+        if expires is not None and expires < time.time():
+            self._entries.pop(key)
+            return None
+        return value
+
+    def set(self, key, value, ttl=None):
+        self._entries.set(key, (time.time() + ttl if ttl else None, value))
+
+    def delete(self, key):
+        self._entries.pop(key)
+
+    def incr(self, key):
+        with self._lock:
+            value = (self.get(key) or 0) + 1
+            self.set(key, value)
+            return value
+
+    def clear(self):
+        self._entries.clear()
+
+
+class SQLiteCache(object):
+    """A cache backend storing entries in a SQLite database file, which can be shared
+    by the worker processes of an application on the same host. Example::
+
+        class User(db.Model):
+            __cache__ = {'ttl': 60, 'backend': SQLiteCache('/tmp/users.cache')}
+    """
+
+    def __init__(self, path, max_entries=10000):
+        self.path = path
+        self.max_entries = max_entries
+        self._local = threading.local()
+        self._writes = 0
+        with self._connection() as conn:
+            conn.execute("CREATE TABLE IF NOT EXISTS cache "
+                         "(key TEXT PRIMARY KEY, value BLOB, expires REAL)")
+
+    def _connection(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = self._local.conn = sqlite3.connect(self.path, timeout=30)
+        return conn
+
+    def get(self, key):
+        row = self._connection().execute(
+            "SELECT value, expires FROM cache WHERE key = ?", (key,)).fetchone()
+        if row is None or (row[1] is not None and row[1] < time.time()):
+            return None
+        # counters are stored as integers, other values pickled
+        return row[0] if isinstance(row[0], int) else pickle.loads(bytes(row[0]))
+
+    def set(self, key, value, ttl=None):
+        value = sqlite3.Binary(pickle.dumps(value, pickle.HIGHEST_PROTOCOL))
+        with self._connection() as conn:
+            conn.execute("INSERT OR REPLACE INTO cache VALUES (?, ?, ?)",
+                         (key, value, time.time() + ttl if ttl else None))
+        self._writes += 1
+        if self._writes % 100 == 0:
+            self._prune()
+
+    def delete(self, key):
+        with self._connection() as conn:
+            conn.execute("DELETE FROM cache WHERE key = ?", (key,))
+
+    def incr(self, key):
+        with self._connection() as conn:
+            conn.execute("INSERT OR IGNORE INTO cache VALUES (?, 0, NULL)", (key,))
+            conn.execute("UPDATE cache SET value = value + 1 WHERE key = ?", (key,))
+            return conn.execute("SELECT value FROM cache WHERE key = ?", (key,)).fetchone()[0]
+
+    def clear(self):
+        with self._connection() as conn:
+            conn.execute("DELETE FROM cache")
+
+    def _prune(self):
+        with self._connection() as conn:
+            conn.execute("DELETE FROM cache WHERE expires < ?", (time.time(),))
+            # replaced entries get a new rowid, so the lowest were written least recently
+            conn.execute("DELETE FROM cache WHERE rowid IN (SELECT rowid FROM cache "
+                         "WHERE typeof(value) != 'integer' ORDER BY rowid "
+                         "LIMIT max(0, (SELECT count(*) FROM cache) - ?))", (self.max_entries,))
+
+
+class _ModelCache(object):
+    """The read-through cache of a model declaring `__cache__`. Holds the column values of
+    records keyed by primary key, and the primary keys of records found by filters keyed
+    by the version of the model which is bumped on every write.
+    """
+
+    def __init__(self, model, config):
+        self.config = config
+        self.ttl = config.get('ttl')
+        self.backend = config.get('backend') or MemoryCache(config.get('max_entries', 10000))
+        self.namespace = '%s:%s' % (_get_mapper(model).local_table.name, model.__name__)
+        self.hits = 0
+        self.misses = 0
+
+    def _key(self, *parts):
+        return ':'.join((self.namespace,) + tuple(str(p) for p in parts))
+
+    def _record_key(self, pk):
+        return self._key(self.backend.get(self._key('epoch')) or 0, repr(pk))
+
+    def info(self):
+        return dict(hits=self.hits, misses=self.misses)
+
+    def find(self, model, pk):
+        obj = _identity_lookup(model, pk)
+        if obj is not None and not orm.attributes.instance_state(obj).expired:
+            return obj
+
+        values = self.backend.get(self._record_key(pk))
+        if values is not None:
+            self.hits += 1
+            return _load_instance(model, values)
+
+        self.misses += 1
+        obj = model.query.get(pk)
+        if obj is not None:
+            self.store(obj)
+        return obj
+
+    def find_by(self, model, filters):
+        key = self._key('by', self.backend.get(self._key('version')) or 0, repr(sorted(filters.items())))
+        pk = self.backend.get(key)
+        if pk is not None:
+            return self.find(model, pk)
+
+        obj = model.where(**filters).order_by('id').first()
+        if obj is not None:
+            self.store(obj)
+            self.backend.set(key, _primary_key_value(obj), self.ttl)
+        return obj
+
+    def store(self, obj):
+        state = orm.attributes.instance_state(obj)
+        # partially loaded records are not cached
+        if state.unloaded:
+            return
+        values = tuple(state.dict[k] for k in _get_columns(obj))
+        self.backend.set(self._record_key(_primary_key_value(obj)), values, self.ttl)
+
+    def touch(self):
+        self.backend.incr(self._key('version'))
+
+    def invalidate(self, pk):
+        self.backend.delete(self._record_key(pk))
+        self.touch()
+
+    def clear(self):
+        self.backend.incr(self._key('epoch'))
+        self.touch()
+
+
+def _primary_key_value(obj):
+    """Returns the primary key value of the instance, as a tuple for composite keys"""
+    pk = tuple(getattr(obj, k) for k in _get_primary_keys(obj))
+    return pk if len(pk) > 1 else pk[0]
+
+
+def _load_instance(model, values, keys=None):
+    """Returns an instance of the model for the column values cached for a record,
+    merged into the current session without querying the database. As with a query,
+    an instance already loaded in the session is returned as is.
+
+    :param keys: the names of the cached columns, all columns by default
+    """
+    keys = keys or _get_columns(model)
+    obj = _get_mapper(model).class_manager.new_instance()
+    for key, value in zip(keys, values):
+        orm.attributes.set_committed_value(obj, key, value)
+
+    current = _identity_lookup(model, _primary_key_value(obj))
+    if current is not None and not orm.attributes.instance_state(current).expired:
+        return current
+    orm.make_transient_to_detached(obj)
+    return model.query.session.merge(obj, load=False)
+
+
+def _column_values(model, objs):
+    """Returns the names of the loaded columns of the given instances and a `tuple`
+    of their values for each, or `None` if they are modified or loaded differently
+    """
+    keys = EMPTY
+    if objs:
+        state = orm.attributes.instance_state(objs[0])
+        keys = tuple(k for k in _get_columns(model) if k in state.dict)
+    rows = []
+    for obj in objs:
+        state = orm.attributes.instance_state(obj)
+        if state.modified or not all(k in state.dict for k in keys):
+            return None
+        rows.append(tuple(state.dict[k] for k in keys))
+    return keys, tuple(rows)
+
+
+def _touch(model, pk=None, clear=False):
+    """Invalidates cached data of the model after a write, i.e. results of queries on
+    its tables, records found by filters and the record with the given primary key
+    value, or all records if `clear` is set
+    """
+    for table in _get_mapper(model).tables:
+        _table_versions[table.name] = _table_versions.get(table.name, 0) + 1
+
+    memo = _request_memo(create=False)
+    if memo is not None:
+        memo.clear()
+
+    cache = _model_info(model).cache
+    if cache is None:
+        return
+    if clear:
+        cache.clear()
+    elif pk is not None:
+        cache.invalidate(pk)
+    else:
+        cache.touch()
+
+
+def _on_record_written(mapper, connection, target):
+    pk = _primary_key_value(target)
+    _touch(type(target), pk)
+    # invalidate again once the transaction ends, as the old values may be
+    # cached by other sessions until it is committed
+    session = orm.object_session(target)
+    if session is not None:
+        session.info.setdefault('activerecord.written', set()).add((type(target), pk))
+
+
+def _on_transaction_end(session, *args):
+    for model, pk in session.info.pop('activerecord.written', EMPTY):
+        _touch(model, pk)
+
+
+def _on_bulk_write(context):
+    _touch(context.mapper.class_, clear=True)
+
+
+class _RequestMemo(object):
+    """The results of read queries issued in a request, cleared on every write"""
+
+    def __init__(self):
+        self.results = {}
+        self.hits = 0
+        self.misses = 0
+
+    def fetch(self, key, load):
+        try:
+            result = self.results[key]
+        except KeyError:
+            self.misses += 1
+            result = self.results[key] = load()
+            return result
+        self.hits += 1
+        return result
+
+    def clear(self):
+        self.results.clear()
+
+    def info(self):
+        return dict(hits=self.hits, misses=self.misses, size=len(self.results))
+
+
+def _request_memo(create=True):
+    """Returns the memo of the current app context if the application enables
+    the `ACTIVERECORD_DEDUPLICATE_QUERIES` config, else `None`
+    """
+    if not flask.has_app_context():
+        return None
+    memo = getattr(flask.g, '_activerecord_memo', None)
+    if memo is None and create and flask.current_app.config.get('ACTIVERECORD_DEDUPLICATE_QUERIES'):
+        memo = flask.g._activerecord_memo = _RequestMemo()
+    return memo
+
+
+def _memoized(model, key, load):
+    """Returns the result of `load()` or that of the same query already issued in the
+    current request, if deduplication of queries is enabled. Queries are issued as
+    usual while the session has changes to flush.
+
+    :param key: a function returning the key identifying the query
+    """
+    memo = _request_memo()
+    if memo is None:
+        return load()
+    session = model.query.session
+    if session.new or session.dirty or session.deleted:
+        return load()
+    return memo.fetch(key(), load)
+
+
+def _statement_key(model, statement):
+    """Returns a key identifying the statement by its SQL and parameter values"""
+    compiled = statement.compile(dialect=_get_bind(model).dialect)
+    return model, str(compiled), repr(sorted(compiled.params.items()))
+
+
+class _CounterCache(object):
+    """A count of the records of a model kept in a column of the parent records of
+    one of its many-to-one relationships, see :attr:`ActiveRecord.__counter_caches__`
+    """
+
+    def __init__(self, model, relation, column):
+        from sqlalchemy import func
+        from sqlalchemy.orm.interfaces import MANYTOONE
+
+        prop = _model_info(model).relationships.get(relation)
+        if prop is None or prop.direction is not MANYTOONE:
+            raise ValueError("Expected a many-to-one relationship '%s.%s' to count"
+                             % (model.__name__, relation))
+        parent_mapper = prop.mapper
+        if column not in parent_mapper.c:
+            raise ValueError("Unknown column '%s.%s'" % (parent_mapper.class_.__name__, column))
+
+        mapper = _get_mapper(model)
+        self.relation = relation
+        self.parent = parent_mapper.class_
+        self.attribute = column
+        self.column = parent_mapper.c[column]
+        self.keys = tuple(mapper.get_property_by_column(local).key for local, _ in prop.local_remote_pairs)
+        self.remote = tuple(remote for _, remote in prop.local_remote_pairs)
+        self.by_primary_key = set(self.remote) == set(parent_mapper.primary_key)
+        if self.by_primary_key:
+            self.primary_key_order = tuple(self.remote.index(c) for c in parent_mapper.primary_key)
+        # the parent of a moved record is decremented with the previous key values,
+        # which an active history listener loads before they are replaced
+        for key in self.keys:
+            attribute = getattr(model, key)
+            if not event.contains(attribute, 'set', _on_counted_key_set):
+                event.listen(attribute, 'set', _on_counted_key_set, active_history=True)
+
+        condition = and_(*[c == bindparam('_key%d' % i) for i, c in enumerate(self.remote)])
+        self.statement = self.column.table.update().where(condition).values(
+            {self.column: func.coalesce(self.column, 0) + bindparam('_amount')})
+
+    def key_values(self, obj):
+        return tuple(getattr(obj, k) for k in self.keys)
+
+    def changes(self, obj):
+        """Returns the previous and current key values of the parent of a record,
+        or `None` if it was not moved to another parent
+        """
+        histories = [orm.attributes.get_history(obj, key) for key in self.keys]
+        if not any(h.deleted or h.added for h in histories):
+            return None
+        previous, current = [], []
+        for key, history in zip(self.keys, histories):
+            if history.deleted or history.added:
+                previous.append(history.deleted[0] if history.deleted else None)
+                current.append(history.added[0] if history.added else None)
+            else:
+                value = history.unchanged[0] if history.unchanged else getattr(obj, key)
+                previous.append(value)
+                current.append(value)
+        return tuple(previous), tuple(current)
+
+    def update(self, connection, session, amounts):
+        """Adds the amounts keyed by parent key values to the counts of the parents.
+        The counts of parents loaded in the session are expired once it is flushed.
+        """
+        params = []
+        for key, amount in amounts.items():
+            if amount and None not in key:
+                values = dict(('_key%d' % i, v) for i, v in enumerate(key))
+                values['_amount'] = amount
+                params.append(values)
+        if not params:
+            return
+        connection.execute(self.statement, params)
+        if not self.by_primary_key:
+            _touch(self.parent, clear=True)
+            return
+        counted = session.info.setdefault('activerecord.counted', set()) if session is not None else set()
+        for values in params:
+            key = tuple(values['_key%d' % i] for i in self.primary_key_order)
+            counted.add((self.parent, key, self.attribute))
+            _touch(self.parent, key if len(key) > 1 else key[0])
+
+    def count_by_parent(self, model, query):
+        """Returns the number of records matched by the query keyed by parent key values"""
+        from sqlalchemy import func
+
+        columns = [getattr(model, k) for k in self.keys]
+        rows = query.with_entities(*(columns + [func.count()])).group_by(*columns).order_by(None)
+        return dict((tuple(row[:-1]), row[-1]) for row in rows)
+
+
+def _on_counted_key_set(target, value, oldvalue, initiator):
+    pass
+
+
+def _on_counted_insert(mapper, connection, target):
+    session = orm.object_session(target)
+    for counter in _model_info(target).counter_caches:
+        counter.update(connection, session, {counter.key_values(target): 1})
+
+
+def _on_counted_update(mapper, connection, target):
+    session = orm.object_session(target)
+    for counter in _model_info(target).counter_caches:
+        changes = counter.changes(target)
+        if changes is not None and changes[0] != changes[1]:
+            counter.update(connection, session, {changes[0]: -1, changes[1]: 1})
+
+
+def _on_counted_delete(mapper, connection, target):
+    session = orm.object_session(target)
+    for counter in _model_info(target).counter_caches:
+        counter.update(connection, session, {counter.key_values(target): -1})
+
+
+def _expire_counts(session, *args):
+    """Expires the counter cache columns updated for parents loaded in the session"""
+    for parent, key, attribute in session.info.pop('activerecord.counted', EMPTY):
+        obj = session.identity_map.get(_get_mapper(parent).identity_key_from_primary_key(list(key)))
+        if obj is not None:
+            session.expire(obj, [attribute])
+
+
+def _counted_write(model, query, write, values=None):
+    """Runs the bulk `write` of the records matched by the query and adjusts the counter
+    caches of their parents, for deleted records or for records moved to other parents
+    if the updated `values` are given
+    """
+    counters = _model_info(model).counter_caches
+    if values is not None:
+        counters = [c for c in counters if not set(c.keys).isdisjoint(values)]
+    if not counters:
+        return write()
+
+    counts = [(counter, counter.count_by_parent(model, query)) for counter in counters]
+    result = write()
+
+    session = model.query.session
+    connection = session.connection(mapper=_get_mapper(model))
+    for counter, parents in counts:
+        amounts = {}
+        for key, count in parents.items():
+            amounts[key] = amounts.get(key, 0) - count
+            if values is not None:
+                key = tuple(values.get(k, v) for k, v in zip(counter.keys, key))
+                amounts[key] = amounts.get(key, 0) + count
+        counter.update(connection, session, amounts)
+    _expire_counts(session)
+    return result
+
+
+event.listen(orm.Session, 'after_flush_postexec', _expire_counts)
+event.listen(orm.Session, 'after_commit', _on_transaction_end)
+event.listen(orm.Session, 'after_soft_rollback', _on_transaction_end)
+event.listen(orm.Session, 'after_bulk_update', _on_bulk_write)
+event.listen(orm.Session, 'after_bulk_delete', _on_bulk_write)
+
+
 class _QueryHelper(object):
     """
-    A query helper interface also used to proxy query methods
+    A query helper interface also used to proxy query methods.
+
+    Query helpers are immutable values. Each chained method returns a new query sharing
+    the unchanged parts, so a base query may be built once and specialized by any thread::
+
+        recent = Article.select().order_by('-pub_date').limit(20)
+        news = recent.where(category='news').all()
     """
 
     def __init__(self, model):
         self._model = model
-        self._scalar = None
+        self._fields = None
         self._options = None
-        self._filters = None
+        self._options_key = None
+        self._where = None
+        self._conditions = None
+        self._shape = ()
+        self._params = {}
+        self._cacheable = True
+        self._order_keys = None
         self._order_by = None
         self._group_by = None
         self._having = None
         self._offset = None
         self._limit = None
         self._compiled = None
+        self._result_cache = None
+
+    def _clone(self, **attributes):
+        """Returns a copy of this query with the given attributes replaced. The other
+        attributes are shared as they are never modified once set.
+        """
+        query = self.__class__.__new__(self.__class__)
+        query.__dict__.update(self.__dict__)
+        query.__dict__.update(attributes)
+        query._compiled = None
+        return query
+
+    def _compile(self):
+        """Returns the `Query` for this query helper, built once without a session so it
+        may be shared by threads using other sessions
+        """
+        compiled = self._compiled
+        if compiled is None:
+            if self._options is None:
+                self._options = _select_options(self._model, *(self._fields or EMPTY))
+
+            query = orm.Query(self._model).options(*self._options)
+            compiled = self._compiled = self._apply_clauses(query)
+        return compiled
+
+    def _resolve(self):
+        """Builds the conditions and the compiled `Query` of this query helper ahead of
+        its first use, e.g. for queries shared by requests
+        """
+        # compiling the query builds its conditions as well
+        self._compile()
+        return self
 
     @property
     def _query(self):
-        if not self._compiled:
-
-            session = self._model.query.session
+        """The `Query` for this query helper bound to the current session"""
+        return self._compile().with_session(self._model.query.session)
+
+    def _apply_clauses(self, query):
+        """Applies the conditions, ordering, grouping and slicing of this query"""
+        if self._filters:
+            query = query.filter(*self._filters)
+        if self._order_by:
+            query = query.order_by(*self._order_by)
+        if self._group_by:
+            query = query.group_by(*self._group_by)
+            if self._having:
+                query = query.having(and_(*self._having))
+        if self._offset and self._offset > 0:
+            query = query.offset(self._offset)
+        if self._limit and self._limit > 0:
+            query = query.limit(self._limit)
+        return query
 
-            if self._scalar is not None:
-                self._model = self._scalar
-                self._options = []
-            elif not self._options:
-                self.select()
-
-            query = session.query(self._model).options(*self._options)
-
-            if self._filters:
-                query = query.filter(*self._filters)
-            if self._order_by:
-                query = query.order_by(*self._order_by)
-            if self._group_by:
-                query = query.group_by(*self._group_by)
-                if self._having:
-                    query = query.having(self._having)
-            if self._offset and self._offset > 0:
-                query = query.offset(self._offset)
-            if self._limit and self._limit > 0:
-                query = query.limit(self._limit)
-            self._compiled = query
-        return self._compiled
+    @property
+    def _filters(self):
+        if self._conditions is None and self._where:
+            criteria, filters = self._where
+            self._conditions = _where_clause(self._model, *criteria, **filters)
+        return self._conditions
+
+    def _statement(self, columns=None):
+        """Returns the cached statement for the shape of this query, i.e. the model,
+        projected fields, filter operators and ordering, bound to the current session
+        and the parameter values of this query. Returns `None` for queries that cannot
+        be cached such as those with SQL expression criteria or grouping.
+
+        :param columns: names of columns to select instead of model instances
+        """
+        if not _bakery or not self._cacheable or self._group_by:
+            return None
+        if self._order_by and self._order_keys is None:
+            return None
+
+        offset = bool(self._offset and self._offset > 0)
+        limit = bool(self._limit and self._limit > 0)
+        if columns:
+            fields = ('pluck',) + columns
+        else:
+            fields = tuple(sorted(set(self._fields))) if self._fields else None
+        key = (self._model, fields, self._options_key, self._shape, self._order_keys, offset, limit)
+
+        statement = _statements.get(key)
+        if statement is None:
+            statement = self._bake(key, offset, limit, columns)
+            _statements.set(key, statement)
+
+        params = dict(self._params)
+        if offset:
+            params['_offset'] = self._offset
+        if limit:
+            params['_limit'] = self._limit
+        return statement(self._model.query.session).params(**params)
+
+    def _bake(self, key, offset, limit, columns=None):
+        # the values bound in these expressions are replaced on each execution
+        model = self._model
+        options = self._options
+        if columns:
+            entities = [getattr(model, k) for k in columns]
+            options = EMPTY
+        else:
+            entities = [model]
+            if options is None:
+                options = _select_options(model, *(self._fields or EMPTY))
+        conditions = self._filters
+        order_by = self._order_by
+
+        def build(query):
+            query = query.options(*options)
+            if conditions:
+                query = query.filter(*conditions)
+            if order_by:
+                query = query.order_by(*order_by)
+            if offset:
+                query = query.offset(bindparam('_offset'))
+            if limit:
+                query = query.limit(bindparam('_limit'))
+            return query
+
+        statement = _bakery(lambda session: session.query(*entities), key)
+        statement += build
+        return statement
+
+    def _memoized(self, name, load):
+        """Deduplicates the read `name` of this query within the current request"""
+        def key():
+            return (name,) + _statement_key(self._model, self._query.statement)
+
+        return _memoized(self._model, key, load)
 
     def all(self):
-        return self._query.all()
+        return list(self._memoized('all', self._all))
+
+    def _all(self):
+        if self._result_cache is not None:
+            return self._cached_result(self._query)
+        statement = self._statement()
+        return statement.all() if statement is not None else self._query.all()
 
     def first(self):
         """Return the first record of this model"""
-        return self._query.first()
+        return self._memoized('first', self._first)
+
+    def _first(self):
+        if self._result_cache is not None:
+            result = self._cached_result(self._query.limit(1))
+            return result[0] if result else None
+        statement = self._statement()
+        return statement.first() if statement is not None else self._query.first()
 
     def one(self):
-        return self._query.one()
+        return self._memoized('one', self._one)
+
+    def _one(self):
+        if self._result_cache is not None:
+            from sqlalchemy.orm.exc import NoResultFound, MultipleResultsFound
+
+            result = self._cached_result(self._query)
+            if not result:
+                raise NoResultFound("No row was found for one()")
+            if len(result) > 1:
+                raise MultipleResultsFound("Multiple rows were found for one()")
+            return result[0]
+        statement = self._statement()
+        return statement.one() if statement is not None else self._query.one()
+
+    def cache(self, ttl=QUERY_CACHE_TTL, key=None):
+        """Cache the records returned by this query in process, so that running the
+        same query again does not hit the database until a table it selects from is
+        written to or the `ttl` expires. Example::
+
+            Article.where(category='news').order_by('-pub_date').limit(20).cache(ttl=60).all()
+
+        Results are keyed by the compiled SQL and its parameters and hold the loaded
+        column values, which are turned back into instances of the model on a hit.
+        Relationships are not cached and load as usual. Writes through the model,
+        including bulk updates and deletes, invalidate the results for its tables, but
+        only within the current process. Writes by other worker processes are seen
+        once the `ttl` expires. Only the latest :data:`QUERY_CACHE_SIZE` results with
+        at most :data:`QUERY_CACHE_MAX_ROWS` rows are kept.
+
+        :param ttl: the number of seconds to keep the result, :data:`QUERY_CACHE_TTL`
+            by default
+        :param key: a name identifying the query instead of its SQL and parameters
+        """
+        if not ttl or ttl <= 0:
+            raise ValueError("Expected a positive ttl to cache '%s' results" % self._model.__name__)
+        return self._clone(_result_cache=(ttl, key))
+
+    def _cached_result(self, query):
+        from sqlalchemy.sql.util import find_tables
+
+        ttl, key = self._result_cache
+        statement = query.statement
+        # read the versions before the query, so a concurrent write makes its result stale
+        versions = tuple(sorted((t.name, _table_versions.get(t.name, 0))
+                                for t in find_tables(statement, include_aliases=True)
+                                if hasattr(t, 'name')))
+        key = _statement_key(self._model, statement) if key is None else (self._model, key)
+        key += versions
+
+        entry = _query_results.get(key)
+        if entry is not None:
+            expires, keys, rows = entry
+            if expires > time.time():
+                return [_load_instance(self._model, values, keys) for values in rows]
+            _query_results.pop(key)
+
+        result = query.all()
+        if len(result) <= QUERY_CACHE_MAX_ROWS:
+            entry = _column_values(self._model, result)
+            if entry is not None:
+                _query_results.set(key, (time.time() + ttl,) + entry)
+        return result
 
     def count(self):
-        """Return a count of records in the query"""
+        """Return a count of records in the query, or of groups for a grouped query"""
+        return self._memoized('count', self._count)
+
+    def _count(self):
         from sqlalchemy import func
 
-        self._scalar = func.count(getattr(self._model, 'id'))
-        return self._query.scalar()
+        session = self._model.query.session
+
+        if self._group_by or self._offset or self._limit:
+            # count the rows of the grouped or sliced query
+            columns = self._group_by or [getattr(self._model, k) for k in _get_primary_keys(self._model)]
+            query = self._apply_clauses(session.query(*columns))
+            return session.query(func.count()).select_from(query.subquery()).scalar()
+
+        query = session.query(func.count()).select_from(self._model)
+        if self._filters:
+            query = query.filter(*self._filters)
+        return query.scalar()
+
+    def aggregate(self, **specs):
+        """Compute aggregates of the records matched by the query in a single `SELECT`.
+        Example::
+
+            Todo.where(done=True).aggregate(total='count', newest=('max', 'pub_date'))
+            # {'total': 12, 'newest': datetime(2015, 6, 1, 10, 30)}
+
+        Each aggregate is given as `'count'` or a tuple of one of `count`, `sum`, `avg`,
+        `min` or `max` and a column name. For a query with :meth:`group_by` a `dict` is
+        returned for each group, also holding the values of the grouped columns.
+        Aggregates of a query with a limit or offset are computed over its rows.
+
+        :param specs: the aggregates keyed by the names to return them with
+        :return: a `dict`, or a `list` of `dict` for a grouped query
+        """
+        from sqlalchemy import func
+
+        if not specs:
+            raise ValueError("Expected aggregates to compute for '%s'" % self._model.__name__)
+
+        session = self._model.query.session
+        source = self._model
+        if not self._group_by and (self._offset or self._limit):
+            # aggregate the rows of the sliced query
+            source = orm.aliased(self._model, self._apply_clauses(session.query(self._model)).subquery())
+
+        names = sorted(specs)
+        columns = []
+        for name in names:
+            spec = specs[name]
+            fn, field = (spec, None) if isinstance(spec, string_types) else spec
+            if fn not in _AGGREGATES:
+                raise ValueError("Unknown aggregate function '%s'" % fn)
+            if field is None:
+                if fn != 'count':
+                    raise ValueError("Expected a column for aggregate '%s'" % name)
+                column = func.count()
+            else:
+                self._column_attributes([field])
+                column = getattr(func, fn)(getattr(source, field))
+            columns.append(column.label(name))
+
+        if not self._group_by:
+            query = session.query(*columns).select_from(source)
+            if source is self._model and self._filters:
+                query = query.filter(*self._filters)
+            return dict(zip(names, query.one()))
+
+        keys = self._group_keys()
+        query = session.query(*(list(self._group_by) + columns)).select_from(self._model)
+        return [dict(zip(keys + names, row)) for row in self._apply_clauses(query)]
+
+    def count_by(self, *fields):
+        """Count the records matched by the query for each value of the given columns,
+        or of those of :meth:`group_by`, in a single `SELECT`. Example::
+
+            Todo.where(user_id=1).count_by('done')
+            # {False: 4, True: 12}
+
+        :param fields: the column names to group by
+        :return: an ordered `dict` of counts keyed by value, or by a tuple of values
+            for several columns
+        """
+        from sqlalchemy import func
+
+        query = self.group_by(*fields) if fields else self
+        if not query._group_by:
+            raise ValueError("Expected columns to count '%s' by" % self._model.__name__)
+
+        columns = list(query._group_by)
+        rows = query._apply_clauses(
+            self._model.query.session.query(*(columns + [func.count()])).select_from(self._model))
+        if len(columns) == 1:
+            return OrderedDict((row[0], row[1]) for row in rows)
+        return OrderedDict((tuple(row[:-1]), row[-1]) for row in rows)
+
+    def _group_keys(self):
+        """Returns the names of the grouped columns, used as keys of aggregate results"""
+        keys = []
+        for i, column in enumerate(self._group_by):
+            keys.append(getattr(column, 'key', None) or 'group_%d' % i)
+        return keys
 
     def delete(self):
         """Delete all records matched by the query"""
-        return self._query.delete()
+        query = self._query
+        return _counted_write(self._model, query, query.delete)
+
+    def update_all(self, synchronize_session='auto', **values):
+        """Update all records matched by the query with a single `UPDATE` statement.
+        Attributes are filtered as in :meth:`ActiveRecord.assign`. Example::
+
+            User.where(country='GH').update_all(fullname='Anonymous')
+
+        :param synchronize_session: strategy for updating records already loaded in the
+            session. One of `'evaluate'`, `'fetch'` or `False`, see :meth:`Query.update`.
+            The default `'auto'` evaluates the criteria in Python if possible else fetches
+        :param \**values: the new attribute values
+        :return: the number of records updated
+        """
+        values = _assignable(self._model, values)
+        if not values:
+            return 0
+
+        query = self._model.query.session.query(self._model)
+        if self._filters:
+            query = query.filter(*self._filters)
+        attributes = dict((getattr(self._model, k), v) for k, v in values.items())
+
+        def update():
+            if synchronize_session == 'auto':
+                from sqlalchemy.exc import InvalidRequestError
+
+                try:
+                    # the criteria is evaluated before any statement is issued
+                    return query.update(attributes, synchronize_session='evaluate')
+                except InvalidRequestError:
+                    return query.update(attributes, synchronize_session='fetch')
+            return query.update(attributes, synchronize_session=synchronize_session)
+
+        return _counted_write(self._model, query, update, values)
+
+    def delete_in_batches(self, batch_size=1000, pause=None, progress=None, start_after=None):
+        """Delete all records matched by the query in batches, committing each batch
+        separately to keep locks and transactions short. Example::
+
+            def report(count, last_key):
+                log.info("purged %d users up to %r", count, last_key)
+
+            User.where(country='XX').delete_in_batches(500, pause=0.1, progress=report)
+
+        Matching records are walked in primary key order. The `progress` callback is
+        called after each batch with the running count and the last primary key value,
+        which may be given as `start_after` to resume an interrupted job.
+
+        :param batch_size: the number of records deleted per transaction
+        :param pause: seconds to sleep between batches
+        :param progress: a callable taking the count so far and the last primary key
+        :param start_after: the primary key value to resume after
+        :return: the number of records deleted
+        """
+        def delete(query, ids):
+            count = _counted_write(self._model, query, lambda: query.delete(synchronize_session=False))
+            _expunge_identities(self._model, ids)
+            return count
+
+        return self._mutate_in_batches(delete, batch_size, pause, progress, start_after)
+
+    def update_in_batches(self, values, batch_size=1000, pause=None, progress=None, start_after=None):
+        """Same as :meth:`delete_in_batches` but updates the matched records with the given
+        values. Attributes are filtered as in :meth:`ActiveRecord.assign`. Example::
+
+            User.where(country='GH').update_in_batches({'fullname': 'Anonymous'}, 500)
+
+        :param values: a `dict` of the new attribute values
+        :return: the number of records updated
+        """
+        values = _assignable(self._model, values)
+        if not values:
+            return 0
+        attributes = dict((getattr(self._model, k), v) for k, v in values.items())
+
+        def update(query, ids):
+            return _counted_write(self._model, query,
+                                  lambda: query.update(attributes, synchronize_session=False), values)
+
+        return self._mutate_in_batches(update, batch_size, pause, progress, start_after)
+
+    def _mutate_in_batches(self, mutate, batch_size, pause, progress, start_after):
+        model = self._model
+        session = model.query.session
+        keys = _get_primary_keys(model)
+        columns = [getattr(model, k) for k in keys]
+        batch_size = _chunk_size(model, batch_size)
+
+        query = session.query(*columns)
+        if self._filters:
+            query = query.filter(*self._filters)
+        query = query.order_by(*columns)
+
+        last, count = start_after, 0
+        while True:
+            seek = query
+            if last is not None:
+                seek = query.filter(_keyset_clause(model, keys, last if len(keys) > 1 else [last]))
+            ids = [tuple(row) if len(keys) > 1 else row[0] for row in seek.limit(batch_size).all()]
+            if not ids:
+                break
+
+            count += mutate(session.query(model).filter(_primary_key_clause(model, ids)), ids)
+            _commit(session)
+            last = ids[-1]
+
+            if progress:
+                progress(count, last)
+            if len(ids) < batch_size:
+                break
+            if pause:
+                time.sleep(pause)
+
+        return count
 
     def exists(self):
-        """Returns true if records exist for this query"""
-        return bool(self.count())
+        """Returns true if records exist for this query. Issues `SELECT EXISTS (...)`
+        which stops at the first matching row instead of counting all of them.
+        """
+        return self._memoized('exists', self._exists)
+
+    def _exists(self):
+        from sqlalchemy import literal_column
+
+        session = self._model.query.session
+        query = session.query(literal_column('1')).select_from(self._model)
+        query = self._apply_clauses(query).limit(1)
+        return session.query(query.exists()).scalar()
 
     def join(self, *props, **kwargs):
         return self._query.join(*props, **kwargs)
 
     def where(self, *criteria, **filters):
         """Specify conditions for use in query.
-         Multiple conditions are join with an `AND` clause. Example::
+         Multiple conditions are join with an `AND` clause, including those of
+         previous calls. Example::
 
             User.where(User.fullname=='John Smith', country=['US', 'GH']).all()
 
@@ -336,8 +1737,25 @@ class _QueryHelper(object):
         :param \**filters: extra filter expressions
         :return:
         """
-        self._filters = _where_clause(self._model, *criteria, **filters)
-        return self
+        if self._where:
+            previous_criteria, previous_filters = self._where
+            if not set(previous_filters).isdisjoint(filters):
+                # a column filtered twice is matched with both conditions, binding
+                # the previous values to parameters distinct from the new ones
+                relations = _model_info(self._model).relation_set
+                shape, params = _where_shape(self._model, **previous_filters)
+                previous_criteria += tuple(_where_clause(self._model, **dict(
+                    (k, v) for k, v in previous_filters.items() if k in relations)))
+                previous_criteria += tuple(_column_conditions(self._model, shape, params, unique=True))
+                previous_filters = {}
+            criteria = previous_criteria + criteria
+            filters = dict(previous_filters, **filters)
+
+        # conditions are only built when the query is not found in the statement cache
+        shape, params = _where_shape(self._model, **filters)
+        cacheable = not criteria and _model_info(self._model).relation_set.isdisjoint(filters)
+        return self._clone(_where=(criteria, filters), _conditions=None, _shape=shape,
+                           _params=params, _cacheable=cacheable)
 
     def select(self, *columns):
         """Columns to project in query. Example::
@@ -346,39 +1764,199 @@ class _QueryHelper(object):
 
         :param \*columns: the column names
         """
-        self._options = _select_options(self._model, *columns)
-        return self
+        return self._clone(_fields=columns, _options=None, _options_key=None)
+
+    def pluck(self, *columns):
+        """Return the values of the given columns for the records matched by the query
+        without loading model instances. Example::
+
+            User.where(country='GH').order_by('fullname').pluck('id', 'fullname')
+            # [(1, 'Ama Mensah'), (4, 'Kofi Boateng')]
+
+        :param columns: the column names
+        :return: a `list` of tuples, or of values if a single column is given
+        """
+        rows = self._rows(columns)
+        if len(columns) == 1:
+            return [row[0] for row in rows]
+        return [tuple(row) for row in rows]
+
+    def values(self, *fields, **kwargs):
+        """Return the records matched by the query as `dict` of JSON values like those of
+        :meth:`ActiveRecord.to_dict`, built straight from the selected columns without
+        loading model instances. Example::
+
+            Todo.where(done=False).values('id', 'title')
+            # [{'id': 1, 'title': 'First Title'}, ...]
+
+        As with `to_dict`, primary keys are always included and *hidden* attributes
+        are left out.
+
+        :param fields: the column names to include, all by default
+        :param hidden: names of other columns to leave out
+        :return: a `list` of `dict`
+        """
+        plan = _serialization_plan(self._model, fields, kwargs.pop('hidden', EMPTY))
+        if plan.relations:
+            raise ValueError("Expected only column names for values of '%s'" % self._model.__name__)
+
+        keys = tuple(k for k, _, _ in plan.columns)
+        converters = [(k, convert) for k, _, convert in plan.columns]
+
+        result = []
+        for row in self._rows(keys):
+            data = {}
+            for (k, convert), v in zip(converters, row):
+                data[k] = v if convert is None or v is None else convert(v)
+            result.append(data)
+        return result
+
+    def records(self):
+        """Return the records matched by the query as read-only, slotted objects
+        holding only the column values. Example::
+
+            todos = Todo.where(done=False).records()
+            todos[0].title, todos[0].to_dict('title')
+
+        Records take a fraction of the memory of mapped instances as they have no
+        instance state or `__dict__` and are not tracked by the session. They support
+        attribute access, :meth:`ActiveRecord.to_dict` field specs for columns, and
+        pickling, but do not load relationships or persist changes.
+
+        :return: a `list` of records
+        """
+        record_class = _record_class(self._model)
+        return [record_class(*row) for row in self._rows(record_class.__slots__)]
+
+    def to_columns(self, *columns, **kwargs):
+        """Return the values of the given columns for the records matched by the query
+        as column vectors, streaming the result in chunks. Example::
+
+            columns = Todo.where(done=True).to_columns('id', 'score')
+            mean = sum(columns['score']) / len(columns['score'])
+
+        Integer, float and boolean columns are stored in compact `array.array` vectors,
+        falling back to a `list` if they contain `NULL` values, as are other columns.
+        With `output='numpy'` the vectors are converted to NumPy arrays and with
+        `output='pandas'` a `pandas.DataFrame` is returned, if those are installed.
+
+        :param columns: the column names, all by default
+        :param chunk_size: the number of rows fetched at a time
+        :param output: `'numpy'` or `'pandas'` for the respective structure
+        :return: an ordered `dict` of column name to vector, or a `DataFrame`
+        """
+        chunk_size = kwargs.pop('chunk_size', 1000)
+        output = kwargs.pop('output', None)
+
+        columns = columns or _get_columns(self._model)
+        attributes = self._column_attributes(columns)
+        mapped = _get_mapper(self._model).c
+        vectors = []
+        for key in columns:
+            try:
+                typecode = _ARRAY_TYPECODES.get(mapped[key].type.python_type)
+            except NotImplementedError:
+                typecode = None
+            vectors.append(array(typecode) if typecode else [])
+
+        query = self._model.query.session.query(*attributes)
+        if _get_bind(self._model).dialect.supports_server_side_cursors:
+            query = query.execution_options(stream_results=True)
+        query = self._apply_clauses(query).yield_per(chunk_size)
+
+        for chunk in _chunked(query, chunk_size):
+            for i, values in enumerate(zip(*chunk)):
+                vector = vectors[i]
+                if isinstance(vector, list):
+                    vector.extend(values)
+                    continue
+                try:
+                    vector.extend(array(vector.typecode, values))
+                except (TypeError, OverflowError):
+                    vectors[i] = vector.tolist() + list(values)
+
+        result = OrderedDict(zip(columns, vectors))
+        if output in ('numpy', 'pandas'):
+            import numpy
+
+            result = OrderedDict((k, numpy.asarray(v)) for k, v in result.items())
+        if output == 'pandas':
+            import pandas
+
+            result = pandas.DataFrame(result, columns=list(columns))
+        return result
+
+    def _column_attributes(self, columns):
+        if not columns:
+            raise ValueError("Expected column names to select from '%s'" % self._model.__name__)
+        info = _model_info(self._model)
+        for key in columns:
+            if key not in info.column_set:
+                raise ValueError("Unknown column '%s.%s'" % (self._model.__name__, key))
+        return [getattr(self._model, k) for k in columns]
+
+    def _rows(self, columns):
+        attributes = self._column_attributes(columns)
+        statement = self._statement(columns)
+        if statement is not None:
+            return statement.all()
+        query = self._model.query.session.query(*attributes)
+        return self._apply_clauses(query).all()
+
+    def to_dicts(self, *fields, **props):
+        """Serialize the records matched by the query to a `list` of `dict` as with
+        :meth:`ActiveRecord.to_dict`. Example::
+
+            Todo.where(done=False).to_dicts('id,title,user.name')
+
+        Only the attributes in the field spec are loaded. Relationship fields are eager
+        loaded to avoid a query per record, collections with a separate `IN` query and
+        many-to-one relations with a join.
+
+        :param fields: the attribute names to include
+        :param props: extra data and options
+        :return: a `list` of `dict` representations of the records
+        """
+        _exclude = props.pop('_exclude', EMPTY)
+        if not isinstance(_exclude, str):
+            # part of the statement cache key
+            _exclude = tuple(_exclude)
+        plan = _serialization_plan(self._model, fields, _exclude)
+
+        query = self._clone(_fields=None, _options=_plan_options(self._model, plan),
+                            _options_key=(fields, _exclude))
+        return plan.serialize(query.all(), props)
 
     def order_by(self, *expressions):
         from sqlalchemy.sql.expression import desc, asc
 
-        self._order_by = []
+        order_keys = expressions
+        order_by = []
         for key in expressions:
-            if isinstance(key, basestring):
+            if isinstance(key, string_types):
                 fn, key = (desc, key[1:]) if key.startswith('-') else (asc, key)
                 field = fn(getattr(self._model, key))
-                self._order_by.append(field)
+                order_by.append(field)
             else:
-                self._order_by.append(key)
-        return self
+                order_keys = None
+                order_by.append(key)
+        return self._clone(_order_keys=order_keys, _order_by=tuple(order_by))
 
     def group_by(self, *criteria):
-        self._group_by = criteria
-        return self
+        """Group the records of the query by the given column names or expressions"""
+        criteria = tuple(getattr(self._model, c) if isinstance(c, string_types) else c for c in criteria)
+        return self._clone(_group_by=criteria)
 
     def having(self, *criteria):
-        self._having = criteria
-        return self
+        return self._clone(_having=criteria)
 
     def offset(self, offset):
-        self._offset = offset
-        return self
+        return self._clone(_offset=offset)
 
     def limit(self, limit):
-        self._limit = limit
-        return self
+        return self._clone(_limit=limit)
 
-    def find_each(self, start=None, batch_size=None):
+    def find_each(self, start=None, batch_size=None, keyset=None, detach=False, isolated=False):
         """Fetch each record efficiently. Similar to :meth:`find_in_batches`
         but yields single objects. Example::
 
@@ -387,11 +1965,11 @@ class _QueryHelper(object):
                 # do something with user
                 pass
         """
-        for rows in self.find_in_batches(start, batch_size):
+        for rows in self.find_in_batches(start, batch_size, keyset, detach, isolated):
             for obj in rows:
                 yield obj
 
-    def find_in_batches(self, start=None, batch_size=None):
+    def find_in_batches(self, start=None, batch_size=None, keyset=None, detach=False, isolated=False):
         """Fetch records in batches. Example::
 
             for user_batch in User.find_in_batches(100):
@@ -401,8 +1979,24 @@ class _QueryHelper(object):
         If the batch_size is not given, the `start` index value is used as the `batch_size`
         if provided and `start` is set to zero.
 
+        Unless an ordering, limit or offset was specified on the query, records are walked
+        in primary key order using keyset pagination. Each batch is then fetched with
+        `WHERE pk > last_seen` instead of an `OFFSET` which re-scans all earlier rows.
+
+        To iterate over large tables with bounded memory, set `detach` to expunge each
+        batch from the session once it has been processed, or `isolated` to load the
+        records in a separate short-lived session instead of the current one. Detached
+        records cannot lazy load attributes which were not loaded with the batch.
+        Pending changes, including those made to the records of a batch, are flushed
+        before detaching, and records already in the session when iterating starts are
+        kept in it. Changes to records loaded in an isolated session are discarded.
+
         :param start: the start position
         :param batch_size: the batch size
+        :param keyset: force (`True`) or disable (`False`) keyset pagination, which cannot
+            be forced for a query with a limit or offset
+        :param detach: flag to expunge processed batches and disable autoflush while iterating
+        :param isolated: flag to load records in a new session closed after iterating
         :return: an generator yielding record batches
         """
         offset = batch_size and start or 0
@@ -413,14 +2007,95 @@ class _QueryHelper(object):
         if batch_size < 1:
             raise Exception("batch_size must be positive")
 
-        while True:
-            rows = self._query.offset(offset).limit(batch_size).all()
-            if rows:
+        if keyset is None:
+            keyset = not (self._order_by or self._offset or self._limit)
+        elif keyset and (self._offset or self._limit):
+            raise ValueError("Keyset pagination of '%s' cannot be combined with a limit or offset"
+                             % self._model.__name__)
+
+        session = self._model.query.session
+        if isolated:
+            session = orm.Session(bind=_get_bind(self._model))
+        query = self._query.with_session(session)
+
+        retained = None
+        if detach and not isolated:
+            # records held by the caller are neither detached nor lose their changes
+            session.flush()
+            retained = set(session.identity_map.keys())
+
+        autoflush = session.autoflush
+        if detach or isolated:
+            session.autoflush = False
+        try:
+            for rows in self._batches(query, offset, batch_size, keyset):
                 yield rows
+                if isolated:
+                    session.expunge_all()
+                elif detach:
+                    # changes made to the batch are lost once it is detached
+                    session.flush()
+                    for obj in rows:
+                        if orm.attributes.instance_state(obj).key not in retained:
+                            session.expunge(obj)
+        finally:
+            session.autoflush = autoflush
+            if isolated:
+                session.close()
+
+    def stream(self, yield_per=1000):
+        """Iterate over the records matched by the query without materializing the
+        whole result. Example::
+
+            for user in User.where(country='GH').stream(500):
+                writer.writerow(user.to_dict())
+
+        Rows are fetched `yield_per` at a time through a server-side cursor on databases
+        supporting them. Otherwise, e.g. on SQLite, they are fetched in detached batches
+        of that size as with :meth:`find_each`, which keeps records already loaded in
+        the session and flushes changes made to the streamed records, so that they are
+        persisted on commit as with a server-side cursor.
+
+        :param yield_per: the number of rows fetched at a time
+        :return: a generator yielding the records
+        """
+        if not _get_bind(self._model).dialect.supports_server_side_cursors:
+            for obj in self.find_each(batch_size=yield_per, detach=True):
+                yield obj
+            return
+
+        query = self._query.execution_options(stream_results=True).yield_per(yield_per)
+        for obj in query:
+            yield obj
+
+    def _batches(self, query, offset, batch_size, keyset):
+        if not keyset:
+            # batches are sliced within the offset and limit of the query
+            remaining = self._limit - offset if self._limit and self._limit > 0 else None
+            offset += self._offset if self._offset and self._offset > 0 else 0
+            while remaining is None or remaining > 0:
+                size = batch_size if remaining is None else min(batch_size, remaining)
+                rows = query.offset(offset).limit(size).all()
+                if rows:
+                    yield rows
+                if len(rows) < size:
+                    return
+                offset += size
+                if remaining is not None:
+                    remaining -= size
+            return
+
+        keys = _get_primary_keys(self._model)
+        query = query.order_by(None).order_by(*[getattr(self._model, k) for k in keys])
+
+        # only the first batch needs to skip rows, the rest seek past the last key seen
+        rows = query.offset(offset or None).limit(batch_size).all()
+        while rows:
+            yield rows
             if len(rows) < batch_size:
-                raise StopIteration()
-            else:
-                offset += batch_size
+                return
+            last = [getattr(rows[-1], k) for k in keys]
+            rows = query.filter(_keyset_clause(self._model, keys, last)).limit(batch_size).all()
 
 
 EMPTY = tuple()
@@ -453,11 +2128,28 @@ class ActiveRecord(flask_sqlalchemy.Model):
             fullname = db.Column(db.String)
             country = db.Column(db.String(2))
 
+    Named scopes are declared with functions refining a query, which are built once
+    when the model is configured and then shared::
+
+        class Todo(db.Model):
+            __scopes__ = {
+                'recent': lambda q: q.where(done=False).order_by('-pub_date')
+            }
+
+        Todo.recent().where(user_id=1).all()
+
     """
 
     #: a `dict` of attribute filters for different purposes
     __attribute_filters__ = {}
 
+    #: a `dict` of named scopes mapped to functions refining a query
+    __scopes__ = {}
+
+    #: a `dict` of many-to-one relationships mapped to a column of the parent model
+    #: holding the number of its records of this model, e.g. `{'user': 'todo_count'}`
+    __counter_caches__ = {}
+
     def __repr__(self):
         return "%s(\n%s\n)" % (
             self.__class__.__name__,
@@ -474,12 +2166,8 @@ class ActiveRecord(flask_sqlalchemy.Model):
 
         :param kwargs: a `dict` with names matching model attributes
         """
-        for key in self.get_columns():
-            if key in self.__attribute_filters__.get('protected', EMPTY):
-                continue
-            attr_accessible = self.__attribute_filters__.get('accessible', EMPTY)
-            if key in kwargs and (not attr_accessible or key in attr_accessible):
-                setattr(self, key, kwargs[key])
+        for key, value in _assignable(self, kwargs).items():
+            setattr(self, key, value)
         return self
 
     def update(self, **kwargs):
@@ -494,7 +2182,7 @@ class ActiveRecord(flask_sqlalchemy.Model):
         """
         self.query.session.add(self)
         if commit:
-            self.query.session.commit()
+            _commit(self.query.session)
         return self
 
     def delete(self, commit=True):
@@ -503,7 +2191,7 @@ class ActiveRecord(flask_sqlalchemy.Model):
         :param commit: flag to determine whether to persist to database instantly
         """
         self.query.session.delete(self)
-        return commit and self.query.session.commit()
+        return commit and _commit(self.query.session)
 
     def to_dict(self, *fields, **kwargs):
         """Serialize the model to a `dict`
@@ -514,9 +2202,45 @@ class ActiveRecord(flask_sqlalchemy.Model):
         """
         return _model_to_dict(self, *fields, **kwargs)
 
+    @classmethod
+    @contextmanager
+    def batch(cls, flush_every=500):
+        """Group the writes of a block into a single unit of work. Example::
+
+            with Todo.batch(flush_every=500):
+                for todo in Todo.where(done=False).find_each():
+                    todo.update(done=True)
+
+        Within the block, records saved, updated, created or deleted are not committed
+        one by one. They are flushed to the database every `flush_every` writes,
+        where the session groups the statements of the same table into `executemany`
+        calls, and committed once when the block exits. If the block raises an
+        exception the whole unit of work is rolled back. Nested blocks are part of the
+        outermost one.
+
+        :param flush_every: the number of writes to queue before flushing them
+        """
+        session = cls.query.session
+        if session.info.get('activerecord.batch') is not None:
+            yield
+            return
+        if flush_every < 1:
+            raise ValueError("flush_every must be positive")
+
+        session.info['activerecord.batch'] = _Batch(flush_every)
+        try:
+            yield
+            del session.info['activerecord.batch']
+            session.commit()
+        except Exception:
+            session.rollback()
+            raise
+        finally:
+            session.info.pop('activerecord.batch', None)
+
     @classmethod
     def get_columns(cls):
-        return _get_columns(cls)
+        return list(_get_columns(cls))
 
     @classmethod
     def create(cls, **kwargs):
@@ -527,28 +2251,187 @@ class ActiveRecord(flask_sqlalchemy.Model):
         """
         return cls(**kwargs).save()
 
+    @classmethod
+    def create_many(cls, records, chunk_size=1000, return_pks=False):
+        """Insert many new records for the model with batched `executemany` statements.
+        Each chunk of records is inserted and committed in its own transaction, so any
+        iterable including a generator may be given without holding it in memory. Example::
+
+            User.create_many(dict(fullname=name, country='GH') for name in names)
+
+        Attributes are filtered as in :meth:`assign`. Model constructors are not called,
+        hence only column defaults apply. Note that fetching the generated primary keys
+        requires a statement per record on most database drivers.
+
+        :param records: an iterable of `dict` attributes for the new records
+        :param chunk_size: the number of records inserted per transaction
+        :param return_pks: flag to return the primary keys of the new records
+        :return: a `list` of primary keys if `return_pks` is set else the number of new records
+        """
+        session = cls.query.session
+        keys = _get_primary_keys(cls)
+        pks, count = [], 0
+
+        counters = _model_info(cls).counter_caches
+        for chunk in _chunked(records, chunk_size):
+            mappings = [_assignable(cls, values) for values in chunk]
+            session.bulk_insert_mappings(cls, mappings, return_defaults=return_pks)
+            for counter in counters:
+                amounts = {}
+                for values in mappings:
+                    key = tuple(values.get(k) for k in counter.keys)
+                    amounts[key] = amounts.get(key, 0) + 1
+                counter.update(session.connection(mapper=_get_mapper(cls)), session, amounts)
+            _expire_counts(session)
+            _commit(session)
+            _touch(cls)
+            count += len(mappings)
+            if return_pks:
+                for values in mappings:
+                    pk = tuple(values[k] for k in keys)
+                    pks.append(pk if len(pk) > 1 else pk[0])
+
+        return pks if return_pks else count
+
     @classmethod
     def destroy(cls, *ids):
         """Delete the records with the given ids
 
         :param ids: primary key ids of records
+        :return: the number of records deleted
         """
-        for pk in ids:
-            cls.find(pk).delete(False)
-        cls.query.session.commit()
+        return cls.destroy_all(ids)
+
+    @classmethod
+    def destroy_all(cls, ids, cascade=True, chunk_size=None, commit=True):
+        """Delete the records with the given ids issuing a statement per chunk of ids.
+        Ids for composite primary keys are given as tuples. Example::
+
+            User.destroy_all(expired_ids, cascade=False)
+
+        With `cascade` set, each chunk of records is loaded with a single `IN` query and
+        deleted through the session so that ORM cascades and events apply. Otherwise
+        `DELETE ... WHERE pk IN (...)` is issued directly, which skips the cascades.
+
+        :param ids: an iterable of primary key ids of records
+        :param cascade: flag to delete through the session applying ORM cascades
+        :param chunk_size: the number of ids per statement, sized for the database by default
+        :param commit: flag to determine whether to persist to database instantly
+        :return: the number of records deleted
+        """
+        session = cls.query.session
+        count = 0
+
+        for chunk in _chunked(ids, chunk_size or _chunk_size(cls)):
+            query = session.query(cls).filter(_primary_key_clause(cls, chunk))
+            if cascade:
+                for obj in query.all():
+                    session.delete(obj)
+                    count += 1
+            else:
+                count += _counted_write(cls, query, lambda: query.delete(synchronize_session=False))
+                _expunge_identities(cls, chunk)
+
+        if commit:
+            _commit(session)
+        return count
+
+    @classmethod
+    def reset_counters(cls, *relations, **kwargs):
+        """Recount the records of this model for the counter cache columns of their parents
+        with a single `UPDATE` statement per relationship. Example::
+
+            Todo.reset_counters('user')
+
+        Counter caches declared with :attr:`__counter_caches__` are kept up to date by
+        writes through the session and the bulk methods of this model, but not by other
+        statements or applications writing to the database.
+
+        :param relations: the names of the relationships to recount, all by default
+        :param commit: flag to determine whether to persist to database instantly
+        """
+        from sqlalchemy import func, select
+
+        commit = kwargs.pop('commit', True)
+        session = cls.query.session
+        for counter in _model_info(cls).counter_caches:
+            if relations and counter.relation not in relations:
+                continue
+            condition = and_(*[getattr(cls, k) == c for k, c in zip(counter.keys, counter.remote)])
+            count = select([func.count()]).where(condition).as_scalar()
+            statement = counter.column.table.update().values({counter.column: count})
+            session.execute(statement, mapper=_get_mapper(counter.parent))
+            _touch(counter.parent, clear=True)
+
+        if commit:
+            _commit(session)
+        else:
+            session.expire_all()
 
     @classmethod
     def find(cls, id):
-        """Find record by the id
+        """Find record by the id. Models declaring `__cache__` are looked up in their
+        read-through cache first.
 
         :param id: the primary key id
         """
-        return cls.query.get(id)
+        cache = _model_info(cls).cache
+        if cache is None:
+            return _memoized(cls, lambda: ('find', cls, repr(id)), lambda: cls.query.get(id))
+        return cache.find(cls, id)
+
+    @classmethod
+    def find_many(cls, ids, preserve_order=True, strict=False, chunk_size=None):
+        """Find the records with the given ids. Records already loaded in the session
+        are taken from its identity map and the rest are fetched with an `IN` query per
+        chunk of ids. Example::
+
+            users = User.find_many([4, 2, 9])
+
+        :param ids: an iterable of primary key ids, as tuples for composite primary keys
+        :param preserve_order: flag to return the records in the order of the given ids
+        :param strict: flag to raise :class:`NoResultFound` if any record is not found,
+            otherwise missing records are skipped
+        :param chunk_size: the number of ids per query, sized for the database by default
+        :return: a `list` of records
+        """
+        from sqlalchemy import inspect
+        from sqlalchemy.orm.exc import NoResultFound
+
+        ids = list(ids)
+        found = {}
+        # the missing ids in order, and as a set for membership tests
+        missing, seen = [], set()
+        for pk in ids:
+            if pk in seen:
+                continue
+            seen.add(pk)
+            obj = _identity_lookup(cls, pk)
+            if obj is not None and not inspect(obj).expired:
+                found[pk] = obj
+            else:
+                missing.append(pk)
+
+        session = cls.query.session
+        keys = _get_primary_keys(cls)
+        for chunk in _chunked(missing, chunk_size or _chunk_size(cls)):
+            for obj in session.query(cls).filter(_primary_key_clause(cls, chunk)):
+                pk = tuple(getattr(obj, k) for k in keys)
+                found[pk if len(keys) > 1 else pk[0]] = obj
+
+        if strict:
+            missing = [pk for pk in missing if pk not in found]
+            if missing:
+                raise NoResultFound("No '%s' records found for ids %r" % (cls.__name__, missing))
+
+        if preserve_order:
+            return [found[pk] for pk in ids if pk in found]
+        return list(found.values())
 
     @classmethod
     def all(cls):
         """Return all records for this model type"""
-        return cls.query.all()
+        return cls.select().all()
 
     @classmethod
     def first(cls):
@@ -572,16 +2455,42 @@ class ActiveRecord(flask_sqlalchemy.Model):
 
     @classmethod
     def find_by(cls, *criteria, **filters):
-        """An alias to using `where(*criteria, **filters).first()` for convenience"""
-        return cls.where(*criteria, **filters).order_by('id').first()
+        """An alias to using `where(*criteria, **filters).first()` for convenience.
+        Models declaring `__cache__` cache the records found by column filters.
+        """
+        cache = _model_info(cls).cache
+        if cache is None or criteria or not _model_info(cls).column_set.issuperset(filters):
+            return cls.where(*criteria, **filters).order_by('id').first()
+        return cache.find_by(cls, filters)
+
+    @classmethod
+    def cache_info(cls):
+        """Returns the hits and misses of the cache of models declaring `__cache__`.
+        The cache is configured with a `dict` of options, e.g.::
+
+            class User(db.Model):
+                __cache__ = {'ttl': 60, 'max_entries': 10000}
+
+        - `ttl`: seconds to keep records cached, forever by default
+        - `max_entries`: the size of the default in-process :class:`MemoryCache`
+        - `backend`: a cache backend such as :class:`SQLiteCache` to use instead
+
+        Records found with :meth:`find` and :meth:`find_by` are cached as column values.
+        They are invalidated whenever records are written through the session or with
+        bulk statements.
+        """
+        cache = _model_info(cls).cache
+        return cache.info() if cache is not None else None
 
     @classmethod
-    def find_each(cls, start=None, batch_size=None):
-        return cls.select().find_each(start=start, batch_size=batch_size)
+    def find_each(cls, start=None, batch_size=None, keyset=None, detach=False, isolated=False):
+        return cls.select().find_each(start=start, batch_size=batch_size, keyset=keyset,
+                                      detach=detach, isolated=isolated)
 
     @classmethod
-    def find_in_batches(cls, start=None, batch_size=None):
-        return cls.select().find_in_batches(start=start, batch_size=batch_size)
+    def find_in_batches(cls, start=None, batch_size=None, keyset=None, detach=False, isolated=False):
+        return cls.select().find_in_batches(start=start, batch_size=batch_size, keyset=keyset,
+                                            detach=detach, isolated=isolated)
 
     @classmethod
     def select(cls, *columns):
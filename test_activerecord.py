@@ -2,11 +2,14 @@ from __future__ import with_statement
 
 import atexit
 import unittest
+from contextlib import contextmanager
 from datetime import datetime
 import flask
 from flask.ext import sqlalchemy
+from sqlalchemy import event
 from sqlalchemy.orm import sessionmaker
-from flask_activerecord import patch_model
+from flask_activerecord import patch_model, statement_cache_info, query_cache_info, \
+    request_cache_info, SQLiteCache
 
 
 # path the default model
@@ -49,6 +52,14 @@ def make_user_model(db):
     return User
 
 
+def make_entry_model(db):
+    class Entry(db.Model):
+        day = db.Column(db.Integer, primary_key=True)
+        seq = db.Column(db.Integer, primary_key=True)
+
+    return Entry
+
+
 class BasicAppTestCase(unittest.TestCase):
     def setUp(self):
         app = flask.Flask(__name__)
@@ -524,6 +535,7 @@ class ActiveRecordTestCase(unittest.TestCase):
         self.User = make_user_model(db)
         db.create_all()
         self.app = app
+        self.db = db
         self.todo_list = self.create_models()
 
     def create_models(self):
@@ -536,9 +548,33 @@ class ActiveRecordTestCase(unittest.TestCase):
         self.User.create(name="Jane", todo=todo_list[1])
         return todo_list
 
+    @contextmanager
+    def record_statements(self):
+        """Collects the SQL statements executed within the block into the yielded list"""
+        statements = []
+
+        def record(conn, cursor, statement, *args):
+            statements.append(statement)
+
+        event.listen(self.db.engine, 'before_cursor_execute', record)
+        try:
+            yield statements
+        finally:
+            event.remove(self.db.engine, 'before_cursor_execute', record)
+
     def test_count(self):
         self.assertEqual(self.Todo.count(), 3)
         self.assertEqual(self.Todo.where(id=2).count(), 1)
+        self.assertEqual(self.Todo.select().limit(2).count(), 2)
+        self.Todo.find(1).update(done=True)
+        self.assertEqual(self.Todo.select().group_by(self.Todo.done).count(), 2)
+
+        db = sqlalchemy.SQLAlchemy(self.app)
+        Entry = make_entry_model(db)
+        db.create_all()
+        Entry.create_many([dict(day=1, seq=1), dict(day=1, seq=2)])
+        self.assertEqual(2, Entry.count())
+        self.assertEqual(1, Entry.where(seq=2).count())
 
     def test_first(self):
         self.assertEqual(self.todo_list[0], self.Todo.first())
@@ -566,10 +602,86 @@ class ActiveRecordTestCase(unittest.TestCase):
         # mismatch
         todo = self.Todo.find_by(title="First Title", text="Second Item")
         self.assertFalse(todo)
+        # match NULL
+        self.Todo.find(2).update(text=None)
+        self.assertEqual(2, self.Todo.find_by(text=None).id)
+        self.assertEqual([2], [t.id for t in self.Todo.where(text=[None]).all()])
+        self.assertEqual(1, self.Todo.where(text=None).count())
+
+    def test_find_many(self):
+        from sqlalchemy.orm.exc import NoResultFound
+
+        self.db.session.expire_all()
+        with self.record_statements() as statements:
+            todos = self.Todo.find_many([3, 1, 99, 3])
+            self.assertEqual([3, 1, 3], [t.id for t in todos])
+            self.assertEqual(1, len(statements))
+            # loaded records are taken from the session
+            self.assertEqual([1, 3], [t.id for t in self.Todo.find_many([1, 3], chunk_size=1)])
+            self.assertEqual(1, len(statements))
+
+        self.assertEqual([1, 2], sorted(t.id for t in self.Todo.find_many([2, 1], preserve_order=False)))
+        self.assertRaises(NoResultFound, self.Todo.find_many, [1, 99], strict=True)
+
+    def test_find_cached(self):
+        db = self.db
+
+        class Note(db.Model):
+            __cache__ = {'ttl': 60, 'max_entries': 10}
+            id = db.Column(db.Integer, primary_key=True)
+            body = db.Column(db.String)
+
+        db.create_all()
+        Note.create_many([dict(body='a'), dict(body='b')])
+        with self.record_statements() as statements:
+            self.assertEqual('a', Note.find(1).body)
+            db.session.expunge_all()
+            self.assertEqual('a', Note.find(1).body)
+            self.assertEqual(1, len(statements))
+            self.assertEqual({'hits': 1, 'misses': 1}, Note.cache_info())
+
+            self.assertEqual(2, Note.find_by(body='b').id)
+            db.session.expunge_all()
+            self.assertEqual(2, Note.find_by(body='b').id)
+            self.assertEqual(2, len(statements))
+
+        # writes invalidate the cache
+        Note.find(1).update(body='c')
+        db.session.expunge_all()
+        self.assertEqual('c', Note.find(1).body)
+        Note.where(id=2).update_all(body='d')
+        db.session.commit()
+        db.session.expunge_all()
+        self.assertEqual(None, Note.find_by(body='b'))
+        self.assertEqual('d', Note.find(2).body)
+        Note.destroy(2)
+        self.assertEqual(None, Note.find(2))
+        self.assertEqual(None, self.Todo.cache_info())
+
+    def test_sqlite_cache(self):
+        import os
+        import tempfile
+
+        fd, path = tempfile.mkstemp()
+        os.close(fd)
+        try:
+            cache = SQLiteCache(path)
+            cache.set('a', (1, 'x'))
+            cache.set('b', 'y', ttl=-1)
+            self.assertEqual((1, 'x'), cache.get('a'))
+            self.assertEqual(None, cache.get('b'))
+            self.assertEqual(1, cache.incr('n'))
+            self.assertEqual(2, SQLiteCache(path).incr('n'))
+            cache.delete('a')
+            self.assertEqual(None, cache.get('a'))
+        finally:
+            os.remove(path)
 
     def test_exists(self):
         self.assertFalse(self.Todo.where(title="Bad Title").exists())
         self.assertTrue(self.Todo.where(title="Second Title").exists())
+        self.assertTrue(self.Todo.select().offset(2).exists())
+        self.assertFalse(self.Todo.select().offset(3).exists())
 
     def test_find_each(self):
         it = self.Todo.find_each()
@@ -582,18 +694,463 @@ class ActiveRecordTestCase(unittest.TestCase):
         self.assertEqual(2, len(next(it)))
         self.assertEqual(1, len(next(it)))
 
+    def test_find_in_batches_keyset(self):
+        batches = list(self.Todo.where(done=False).find_in_batches(2))
+        self.assertEqual([[1, 2], [3]], [[t.id for t in rows] for rows in batches])
+        # offset pagination is kept for custom orderings
+        batches = list(self.Todo.select().order_by('-id').find_in_batches(2))
+        self.assertEqual([[3, 2], [1]], [[t.id for t in rows] for rows in batches])
+        # skip the first row
+        ids = [t.id for t in self.Todo.find_each(1, 1)]
+        self.assertEqual([2, 3], ids)
+        self.assertRaises(ValueError, list, self.Todo.select().limit(2).find_each(keyset=True))
+        self.assertRaises(ValueError, list, self.Todo.select().offset(1).find_in_batches(keyset=True))
+
+    def test_find_in_batches_composite_keyset(self):
+        db = sqlalchemy.SQLAlchemy(self.app)
+        Entry = make_entry_model(db)
+        db.create_all()
+        for day, seq in [(2, 1), (1, 2), (1, 1), (2, 2), (3, 1)]:
+            Entry(day=day, seq=seq).save(False)
+        db.session.commit()
+
+        keys = [(e.day, e.seq) for e in Entry.find_each(batch_size=2)]
+        self.assertEqual([(1, 1), (1, 2), (2, 1), (2, 2), (3, 1)], keys)
+
+    def test_find_each_detached(self):
+        session = self.Todo.query.session
+        session.expunge_all()
+
+        todos = []
+        for todo in self.Todo.find_each(batch_size=2, detach=True):
+            self.assertTrue(todo in session)
+            self.assertFalse(session.autoflush)
+            todos.append(todo)
+        self.assertTrue(session.autoflush)
+        self.assertEqual(3, len(todos))
+        self.assertFalse(any(todo in session for todo in todos))
+
+        titles = [todo.title for todo in self.Todo.where(done=False).find_each(isolated=True)]
+        self.assertEqual(['First Title', 'Second Title', 'Third Title'], titles)
+        self.assertEqual(0, len(session.identity_map))
+
+        # records held by the caller keep their changes
+        todo = self.Todo.find(1)
+        todo.title = 'Changed'
+        self.assertEqual(3, len(list(self.Todo.find_each(batch_size=2, detach=True))))
+        self.assertTrue(todo in session)
+        session.commit()
+        session.expunge_all()
+        self.assertEqual('Changed', self.Todo.find(1).title)
+
+        # changes to records of a batch are flushed before it is detached
+        session.expunge_all()
+        for todo in self.Todo.find_each(batch_size=2, detach=True):
+            todo.text = 'Edited'
+        with self.Todo.batch(flush_every=10):
+            for todo in self.Todo.find_each(batch_size=2, detach=True):
+                todo.update(done=True)
+        session.commit()
+        self.assertEqual([('Edited', True)] * 3, [(t.text, t.done) for t in self.Todo.all()])
+
+    def test_stream(self):
+        it = self.Todo.where(id=[2, 3]).stream(yield_per=1)
+        self.assertEqual('Second Title', next(it).title)
+        self.assertEqual([3], [todo.id for todo in it])
+
+        # the limit and offset of the query are kept
+        self.Todo.create_many([dict(title='Fourth Title'), dict(title='Fifth Title')])
+        self.assertEqual([1, 2], [t.id for t in self.Todo.select().limit(2).stream(1)])
+        self.assertEqual([5, 4], [t.id for t in self.Todo.select().order_by('-id').limit(2).stream()])
+        self.assertEqual([3, 4, 5], [t.id for t in self.Todo.select().offset(2).stream(2)])
+        self.assertEqual([3, 4], [t.id for t in self.Todo.select().offset(1).limit(3).find_each(1, 1)])
+        self.Todo.destroy(4, 5)
+
+        # records held by the caller keep their changes
+        session = self.Todo.query.session
+        todo = self.Todo.find(2)
+        todo.title = 'Changed'
+        self.assertEqual(3, len(list(self.Todo.select().stream(2))))
+        self.assertTrue(todo in session)
+        session.commit()
+        session.expunge_all()
+        self.assertEqual('Changed', self.Todo.find(2).title)
+
+        # changes to streamed records are persisted
+        for todo in self.Todo.select().stream(2):
+            todo.text = 'Streamed'
+        session.commit()
+        self.assertEqual(['Streamed'] * 3, [t.text for t in self.Todo.all()])
+
     def test_json_value(self):
         todo_json = self.todo_list[0].to_dict()
         self.assertTrue(isinstance(todo_json, dict))
         self.assertTrue('title' in todo_json and 'text' in todo_json)
         self.assertEqual(5, len(todo_json))
 
+    def test_create_many(self):
+        records = (dict(title='Todo %d' % i, text='Bulk') for i in range(5))
+        self.assertEqual(5, self.Todo.create_many(records, chunk_size=2))
+        self.assertEqual(5, self.Todo.where(text='Bulk').count())
+
+        self.Todo.__attribute_filters__ = {'protected': ('text',)}
+        pks = self.Todo.create_many([dict(title='Extra', text='Ignored')], return_pks=True)
+        self.assertEqual([9], pks)
+        self.assertEqual(None, self.Todo.find(9).text)
+
+    def test_to_dict(self):
+        users = self.User.all()
+        data = self.User.find(1).to_dict('name,todo.title')
+        self.assertEqual({'id': 1, 'name': 'Bill', 'todo': {'id': 1, 'title': 'First Title'}}, data)
+
+        data = users[0].to_dict('todo', _exclude='todo_id')
+        self.assertEqual(['id', 'name', 'todo'], sorted(data))
+        self.assertEqual(self.todo_list[0].pub_date.isoformat(), data['todo']['pub_date'])
+
+        self.User.__attribute_filters__ = {'hidden': ('name',)}
+        data = [u.to_dict('name', 'todo_id', rank=lambda u: u.id * 10) for u in users]
+        self.assertEqual([{'id': 1, 'todo_id': 1, 'rank': 10}, {'id': 2, 'todo_id': 2, 'rank': 20}], data)
+
+        # cached plans follow reassigned filters, also of nested relations
+        todo = self.todo_list[0]
+        self.assertEqual(['id', 'text', 'title'], sorted(todo.to_dict('title,text')))
+        self.assertEqual(['id', 'text'], sorted(users[0].to_dict('todo.text')['todo']))
+        self.Todo.__attribute_filters__ = {'hidden': ('text',)}
+        self.assertEqual(['id', 'title'], sorted(todo.to_dict('title,text')))
+        self.assertEqual(['id'], sorted(users[0].to_dict('todo.text')['todo']))
+
+    def test_to_dicts(self):
+        self.db.session.expire_all()
+        with self.record_statements() as statements:
+            data = self.User.where(id=[1, 2]).to_dicts('name,todo.title', n=1)
+
+        self.assertEqual(1, len(statements))
+        self.assertFalse('text' in statements[0])
+        self.assertEqual([{'id': 1, 'name': 'Bill', 'n': 1, 'todo': {'id': 1, 'title': 'First Title'}},
+                          {'id': 2, 'name': 'Jane', 'n': 1, 'todo': {'id': 2, 'title': 'Second Title'}}], data)
+
+        data = self.Todo.where(id=1).to_dicts('title,text,done', _exclude=['text', 'done'])
+        self.assertEqual([{'id': 1, 'title': 'First Title'}], data)
+
     def test_delete_and_destroy(self):
         self.todo_list[0].delete()
         self.assertEqual(2, self.Todo.count())
-        self.Todo.destroy(2, 3)
+        self.assertEqual(2, self.Todo.destroy(2, 3, 4))
         self.assertEqual(0, self.Todo.count())
 
+    def test_destroy_all(self):
+        todo = self.Todo.find(3)
+        self.assertEqual(2, self.Todo.destroy_all([1, 3], cascade=False, chunk_size=1))
+        self.assertFalse(todo in self.Todo.query.session)
+        self.assertEqual([2], [t.id for t in self.Todo.all()])
+
+        db = sqlalchemy.SQLAlchemy(self.app)
+        Entry = make_entry_model(db)
+        db.create_all()
+        for day, seq in [(1, 1), (1, 2), (2, 1)]:
+            Entry(day=day, seq=seq).save(False)
+        db.session.commit()
+
+        self.assertEqual(2, Entry.destroy_all([(1, 2), (2, 1), (3, 3)], cascade=False))
+        self.assertEqual([(1, 1)], [(e.day, e.seq) for e in Entry.all()])
+
+    def test_update_all(self):
+        todo = self.Todo.find(1)
+        self.assertEqual(2, self.Todo.where(id=[1, 2]).update_all(text='Changed', bogus=1))
+        self.assertEqual('Changed', todo.text)
+        self.Todo.query.session.commit()
+        self.assertEqual(2, self.Todo.where(text='Changed').count())
+
+        self.Todo.__attribute_filters__ = {'accessible': ('done',)}
+        self.assertEqual(0, self.Todo.where(id=3).update_all(text='Ignored'))
+        self.assertEqual(1, self.Todo.where(id=3).update_all('fetch', text='Ignored', done=True))
+        self.assertEqual('Third Item', self.Todo.find(3).text)
+
+    def test_mutate_in_batches(self):
+        self.Todo.create_many(dict(title='Todo %d' % i, text='Bulk') for i in range(7))
+        calls = []
+
+        def progress(count, last):
+            calls.append((count, last))
+
+        count = self.Todo.where(text='Bulk').update_in_batches({'done': True}, 3, progress=progress)
+        self.assertEqual(7, count)
+        self.assertEqual([(3, 6), (6, 9), (7, 10)], calls)
+        self.assertEqual(7, self.Todo.where(done=True).count())
+
+        # resume after the first batch
+        self.assertEqual(4, self.Todo.where(done=True).delete_in_batches(2, start_after=6))
+        self.assertEqual([1, 2, 3, 4, 5, 6], [t.id for t in self.Todo.all()])
+
+    def test_statement_cache(self):
+        info = statement_cache_info()
+        todos = self.Todo.where(title='First Title').all()
+        self.assertEqual([1], [t.id for t in todos])
+        todos = self.Todo.where(title='Second Title').all()
+        self.assertEqual([2], [t.id for t in todos])
+        self.assertEqual(info['misses'] + 1, statement_cache_info()['misses'])
+        self.assertEqual(info['hits'] + 1, statement_cache_info()['hits'])
+
+        # IN lists of 3 and 4 values share a shape
+        todos = self.Todo.where(id=[1, 2, 3]).order_by('-id').limit(2).all()
+        self.assertEqual([3, 2], [t.id for t in todos])
+        todo = self.Todo.where(id=[1, 2, 3, 4]).order_by('-id').limit(2).first()
+        self.assertEqual(3, todo.id)
+        self.assertEqual(info['hits'] + 2, statement_cache_info()['hits'])
+
+    def test_query_cache(self):
+        def query():
+            return self.Todo.where(done=False).order_by('-id').limit(2).cache(ttl=60)
+
+        info = query_cache_info()
+        with self.record_statements() as statements:
+            self.assertEqual([3, 2], [t.id for t in query().all()])
+            self.db.session.expunge_all()
+            self.assertEqual(['Third Title', 'Second Title'], [t.title for t in query().all()])
+            self.assertEqual(3, query().first().id)
+            self.assertEqual(2, len(statements))
+            self.assertEqual(info['hits'] + 1, query_cache_info()['hits'])
+
+        # writes to the table invalidate cached results
+        self.Todo.find(3).update(done=True)
+        self.assertEqual([2, 1], [t.id for t in query().all()])
+        self.Todo.where(id=2).update_all(done=True)
+        self.assertEqual([1], [t.id for t in query().all()])
+        self.Todo.create(title='Fourth Title', text='Fourth Item')
+        self.assertEqual([4, 1], [t.id for t in query().all()])
+        self.assertEqual(4, self.Todo.where(id=4).cache(key='fourth').one().id)
+        self.assertRaises(ValueError, self.Todo.select().cache, None)
+
+    def test_request_deduplication(self):
+        with self.app.app_context():
+            self.assertEqual(None, request_cache_info())
+
+        self.app.config['ACTIVERECORD_DEDUPLICATE_QUERIES'] = True
+        with self.app.app_context(), self.record_statements() as statements:
+            self.db.session.expire_all()
+            for _ in range(3):
+                self.assertEqual('First Title', self.Todo.find(1).title)
+                self.assertEqual(3, self.Todo.count())
+                self.assertEqual(2, len(self.Todo.where(id=[1, 2]).all()))
+                self.assertEqual(None, self.Todo.find_by(title='None'))
+            self.assertEqual(4, len(statements))
+            self.assertEqual(dict(hits=8, misses=4, size=4), request_cache_info())
+
+            # writes clear the memo
+            self.Todo.create(title='Fourth Title', text='Fourth Item')
+            self.assertEqual(4, self.Todo.count())
+
+        with self.app.app_context():
+            self.assertEqual(dict(hits=0, misses=0, size=0), request_cache_info())
+
+    def test_immutable_query(self):
+        import threading
+
+        base = self.Todo.select().order_by('-id')
+        first_two = base.where(id=[1, 2, 3]).where(id=[1, 2])
+        self.assertEqual([3, 2, 1], [t.id for t in base.all()])
+        self.assertEqual([2, 1], [t.id for t in first_two.all()])
+        self.assertEqual([2], [t.id for t in first_two.limit(1).all()])
+        self.assertEqual(2, first_two.count())
+        self.assertEqual([], base.where(id=1).where(id=2).all())
+        self.assertEqual(0, base.where(id=1).where(id=2).count())
+        self.assertEqual([2], [t.id for t in base.where(id=[2, 3]).where(id=[1, 2]).all()])
+        self.assertEqual(3, base.count())
+
+        # derived queries are bound to the session of the thread running them
+        sessions = []
+
+        def run():
+            sessions.append((base.limit(1).one().id, base._query.session))
+            self.db.session.remove()
+
+        thread = threading.Thread(target=run)
+        thread.start()
+        thread.join()
+        self.assertEqual(3, sessions[0][0])
+        self.assertFalse(sessions[0][1] is self.db.session())
+
+    def test_scopes(self):
+        db = self.db
+
+        class Task(db.Model):
+            __scopes__ = {
+                'pending': lambda q: q.where(done=False).order_by('-id'),
+                'titles': lambda q: q.select('id', 'title').order_by('title'),
+            }
+            id = db.Column(db.Integer, primary_key=True)
+            title = db.Column(db.String)
+            done = db.Column(db.Boolean)
+
+        db.create_all()
+        Task.create_many([dict(title='b', done=False), dict(title='a', done=True),
+                          dict(title='c', done=False)])
+        self.assertTrue(Task.pending() is Task.pending())
+        self.assertEqual([3, 1], [t.id for t in Task.pending().all()])
+        self.assertEqual([1], [t.id for t in Task.pending().where(title='b').all()])
+        self.assertEqual(2, Task.pending().count())
+        self.assertEqual(['a', 'b', 'c'], [t.title for t in Task.titles().all()])
+
+        with self.assertRaises(ValueError):
+            class Conflict(db.Model):
+                __scopes__ = {'where': lambda q: q}
+                id = db.Column(db.Integer, primary_key=True)
+
+    def test_aggregate(self):
+        from sqlalchemy import func
+
+        self.Todo.where(id=[1, 2]).update_all(done=True)
+        self.db.session.commit()
+        result = self.Todo.select().aggregate(total='count', first=('min', 'title'),
+                                              last=('max', 'id'), ids=('sum', 'id'))
+        self.assertEqual(dict(total=3, first='First Title', last=3, ids=6), result)
+        self.assertEqual(dict(total=1), self.Todo.where(done=False).aggregate(total='count'))
+        self.assertEqual(dict(mean=1.5), self.Todo.select().order_by('id').limit(2).aggregate(mean=('avg', 'id')))
+
+        result = self.Todo.select().group_by('done').order_by('done').aggregate(n='count', last=('max', 'id'))
+        self.assertEqual([dict(done=False, n=1, last=3), dict(done=True, n=2, last=2)], result)
+        self.assertEqual({False: 1, True: 2}, self.Todo.select().count_by('done'))
+        counts = self.Todo.select().group_by('done').having(func.count() > 1).count_by()
+        self.assertEqual({True: 2}, counts)
+        self.assertEqual({(True, 1): 1, (True, 2): 1}, self.Todo.where(done=True).count_by('done', 'id'))
+
+        self.assertRaises(ValueError, self.Todo.select().aggregate, mean='avg')
+        self.assertRaises(ValueError, self.Todo.select().aggregate, x=('median', 'id'))
+
+    def test_counter_caches(self):
+        db = self.db
+
+        class Owner(db.Model):
+            id = db.Column(db.Integer, primary_key=True)
+            item_count = db.Column(db.Integer, default=0)
+
+        class Item(db.Model):
+            __counter_caches__ = {'owner': 'item_count'}
+            id = db.Column(db.Integer, primary_key=True)
+            owner_id = db.Column(db.Integer, db.ForeignKey('owner.id'))
+            owner = db.relationship('Owner')
+
+        db.create_all()
+        first, second = Owner.create(), Owner.create()
+
+        def counts():
+            return [first.item_count, second.item_count]
+
+        item = Item.create(owner_id=1)
+        Item.create(owner_id=2)
+        self.assertEqual([1, 1], counts())
+        item.update(owner_id=2)
+        self.assertEqual([0, 2], counts())
+        item.owner = first
+        item.save()
+        self.assertEqual([1, 1], counts())
+        item.delete()
+        self.assertEqual([0, 1], counts())
+
+        Item.create_many([dict(owner_id=1), dict(owner_id=1), dict(owner_id=2)])
+        self.assertEqual([2, 2], counts())
+        Item.where(owner_id=1).update_all(owner_id=2)
+        db.session.commit()
+        self.assertEqual([0, 4], counts())
+        self.assertEqual(2, Item.destroy_all([2, 3], cascade=False))
+        self.assertEqual([0, 2], counts())
+        self.assertEqual(1, Item.where(id=4).delete_in_batches())
+        self.assertEqual([0, 1], counts())
+
+        Owner.select().update_all(item_count=9)
+        db.session.commit()
+        Item.reset_counters()
+        self.assertEqual([0, 1], counts())
+
+    def test_batch(self):
+        commits = []
+
+        def record(session):
+            commits.append(session)
+
+        session = self.db.session()
+        event.listen(session, 'after_commit', record)
+        with self.Todo.batch(flush_every=2):
+            for i in range(4):
+                self.Todo.create(title='Batch %d' % i, text='Batch')
+            self.Todo.find(1).update(done=True)
+            self.Todo.find(2).delete()
+            with self.Todo.batch():
+                self.Todo.create(title='Nested', text='Batch')
+            self.assertEqual(7, self.Todo.count())
+        self.assertEqual(1, len(commits))
+        self.assertEqual(7, self.Todo.count())
+        self.assertEqual(True, self.Todo.find(1).done)
+
+        def fail():
+            with self.Todo.batch():
+                self.Todo.create(title='Lost', text='Batch')
+                self.Todo.find(1).update(done=False)
+                raise RuntimeError()
+
+        self.assertRaises(RuntimeError, fail)
+        self.assertEqual(7, self.Todo.count())
+        self.assertEqual(True, self.Todo.find(1).done)
+        self.Todo.find(3).update(done=True)
+        self.assertEqual(2, len(commits))
+        event.remove(session, 'after_commit', record)
+
+    def test_pluck(self):
+        self.assertEqual([1, 2, 3], self.Todo.select().pluck('id'))
+        rows = self.Todo.where(id=[1, 2, 3]).order_by('-id').limit(2).pluck('id', 'title')
+        self.assertEqual([(3, 'Third Title'), (2, 'Second Title')], rows)
+        rows = self.Todo.where(self.Todo.title != 'First Title').pluck('text')
+        self.assertEqual(['Second Item', 'Third Item'], rows)
+        self.assertRaises(ValueError, self.Todo.select().pluck, 'todo_id')
+
+    def test_values(self):
+        rows = self.Todo.where(id=[1, 2]).values('title')
+        self.assertEqual([{'id': 1, 'title': 'First Title'}, {'id': 2, 'title': 'Second Title'}], rows)
+
+        todo = self.todo_list[2]
+        rows = self.Todo.where(id=3).values(hidden='text,done')
+        self.assertEqual([todo.to_dict(_exclude=('text', 'done'))], rows)
+        self.assertEqual(todo.pub_date.isoformat(), rows[0]['pub_date'])
+
+        self.User.__attribute_filters__ = {'hidden': ('todo_id',)}
+        self.assertEqual([{'id': 1, 'name': 'Bill'}], self.User.where(id=1).values())
+
+        # filters reassigned after a first call are honored
+        self.assertEqual(['id', 'text', 'title'], sorted(self.Todo.where(id=1).values('title,text')[0]))
+        self.Todo.__attribute_filters__ = {'hidden': ('text',)}
+        self.assertEqual([{'id': 1, 'title': 'First Title'}], self.Todo.where(id=1).values('title,text'))
+        self.assertRaises(ValueError, self.User.select().values, 'name,todo.title')
+
+    def test_to_columns(self):
+        from array import array
+
+        self.Todo.create_many([dict(title='Untitled')])
+        columns = self.Todo.select().to_columns('id', 'title', 'done', chunk_size=2)
+        self.assertEqual(['id', 'title', 'done'], list(columns))
+        self.assertTrue(isinstance(columns['id'], array))
+        self.assertEqual([1, 2, 3, 4], list(columns['id']))
+        self.assertEqual(['First Title', 'Second Title', 'Third Title', 'Untitled'], columns['title'])
+        # NULL values do not fit in an array
+        self.assertEqual([False, False, False, None], columns['done'])
+
+        columns = self.Todo.where(id=[1, 2]).to_columns()
+        self.assertEqual(self.Todo.get_columns(), list(columns))
+        self.assertEqual(array('b', [False, False]), columns['done'])
+
+    def test_records(self):
+        import copy
+
+        records = self.Todo.where(done=False).order_by('-id').records()
+        self.assertEqual([3, 2, 1], [r.id for r in records])
+        record = records[-1]
+        self.assertEqual('First Title', record.title)
+        self.assertEqual(self.todo_list[0].to_dict('title'), record.to_dict('title'))
+        self.assertRaises(AttributeError, setattr, record, 'title', 'Changed')
+        self.assertRaises(AttributeError, setattr, record, 'extra', 1)
+        self.assertFalse(hasattr(record, '__dict__'))
+        self.assertEqual(record, copy.deepcopy(record))
+        self.assertRaises(ValueError, self.User.select().records()[0].to_dict, 'todo')
+
     def test_order_by(self):
         todos = self.Todo.select('id').order_by('-id').all()
         for i in range(len(todos)):